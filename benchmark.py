@@ -0,0 +1,268 @@
+"""会話APIの負荷・レイテンシベンチマーク
+
+偽LLMバックエンド（LLM_BACKEND=fake）でアプリをプロセス内に立ち上げ、
+同時ユーザーごとに /api/session/create → N回の /api/conversation/message → /api/conversation/end を流す。
+スループット、エンドポイント別・パイプラインステージ別の p50/p95/p99、ピークRSSをJSONに保存する。
+フォールバックで応答した（degraded が空でない）レスポンスは、正常な応答とは別に数える。
+
+既定ではLLM送出制御（レート上限・同時実行数上限）を外し、パイプライン自体を計測する。
+本番と同じ送出制御込みで計測するときは --scheduler をつける。計測時の設定は結果の config に残る。
+
+使い方（httpx が必要: pip install httpx）:
+    python benchmark.py --users 50 --turns 5
+    python benchmark.py --users 50 --turns 5 --compare bench_results/baseline.json
+    python benchmark.py --users 50 --turns 5 --scheduler   # 送出制御込み
+
+--compare を付けると基準結果と比べ、p95 が --tolerance 倍を超えて悪化していれば終了コード1で終わる。
+基準結果と計測時の設定（config）が違う場合は警告を出す。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List
+
+SAMPLE_MESSAGES = [
+    "こんばんは！今日は仕事帰りに寄ってみました",
+    "最近カフェ巡りにハマってるんですよ、おすすめありますか？",
+    "週末に映画を見に行ったんですけど、すごく感動しました！",
+    "料理はあんまりしないんですけど、パスタなら作れます",
+    "ありがとう、そう言ってもらえると嬉しいです",
+    "そうなんですね",
+    "はい",
+    "仕事が忙しくて最近ちょっと疲れ気味なんです",
+    "旅行だったら沖縄に行ってみたいなって思ってます",
+    "K-POPはあまり詳しくないけど、気になってるグループはいます",
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": round(max(values), 1) if values else 0.0,
+    }
+
+
+# 送出制御を外すときの設定（レート上限なし・同時実行数上限は事実上なし）
+UNLIMITED_SCHEDULER_ENV = {"GEMINI_RPM_LIMIT": "0", "GEMINI_MAX_CONCURRENCY": "1000000"}
+
+# 結果の比較に影響するため config に記録する main の設定
+RECORDED_SETTINGS = (
+    "GEMINI_RPM_LIMIT",
+    "GEMINI_RATE_BURST",
+    "GEMINI_MAX_CONCURRENCY",
+    "LLM_SHED_WAIT_FEEDBACK_MS",
+    "LLM_SHED_WAIT_BACKGROUND_MS",
+    "REQUEST_DEADLINE_MS",
+    "CIRCUIT_BREAKER",
+    "BOT_HEDGING",
+    "BACKGROUND_FEEDBACK",
+    "EMOTION_BATCHING",
+    "LOCAL_EMOTION_CLASSIFIER",
+)
+
+
+def peak_rss_mb() -> float:
+    """このプロセスのピークRSS（MB）"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return round(max_rss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+async def simulate_user(client, user_index: int, turns: int, options, endpoint_latencies, stage_latencies, errors,
+                        degraded):
+    rng = random.Random(f"{options.seed}:{user_index}")
+
+    async def timed_post(endpoint: str, payload=None):
+        started = time.perf_counter()
+        response = await client.post(endpoint, json=payload)
+        endpoint_latencies.setdefault(endpoint, []).append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+            return None
+        body = response.json()
+        # 200でもフォールバックで応答したステージがあれば別に数える
+        if body.get("degraded"):
+            counts = degraded.setdefault(endpoint, {"responses": 0, "stages": {}})
+            counts["responses"] += 1
+            for stage in body["degraded"]:
+                counts["stages"][stage] = counts["stages"].get(stage, 0) + 1
+        return body
+
+    created = await timed_post("/api/session/create")
+    if created is None:
+        return
+    session_id = created["session_id"]
+    for _ in range(turns):
+        payload = {"session_id": session_id, "user_message": rng.choice(SAMPLE_MESSAGES)}
+        if options.single_call:
+            payload["single_call"] = True
+        result = await timed_post("/api/conversation/message", payload)
+        if result:
+            for stage, elapsed in (result.get("stage_timings") or {}).items():
+                stage_latencies.setdefault(stage, []).append(elapsed)
+    await timed_post("/api/conversation/end", {"session_id": session_id})
+
+
+async def run_benchmark(options) -> dict:
+    import httpx
+    import main
+
+    endpoint_latencies: Dict[str, List[float]] = {}
+    stage_latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    degraded: Dict[str, dict] = {}
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+        semaphore = asyncio.Semaphore(options.users)
+
+        async def limited(user_index: int):
+            async with semaphore:
+                if options.ramp_seconds:
+                    await asyncio.sleep(options.ramp_seconds * user_index / options.users)
+                await simulate_user(client, user_index, options.turns, options,
+                                    endpoint_latencies, stage_latencies, errors, degraded)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(i) for i in range(options.users * options.rounds)))
+        elapsed = time.perf_counter() - started
+
+    total_requests = sum(len(values) for values in endpoint_latencies.values())
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "users": options.users,
+            "rounds": options.rounds,
+            "turns": options.turns,
+            "single_call": options.single_call,
+            "llm_backend": os.environ.get("LLM_BACKEND"),
+            "fake_latency_ms": os.environ.get("FAKE_LLM_LATENCY_MS"),
+            "fake_error_rate": os.environ.get("FAKE_LLM_ERROR_RATE"),
+            "scheduler": options.scheduler,
+            **{name.lower(): getattr(main, name) for name in RECORDED_SETTINGS},
+        },
+        "duration_s": round(elapsed, 2),
+        "throughput_rps": round(total_requests / elapsed, 1) if elapsed else 0.0,
+        "conversations_per_s": round(options.users * options.rounds / elapsed, 2) if elapsed else 0.0,
+        "endpoints": {
+            endpoint: {**summarize(values), "degraded": degraded.get(endpoint, {}).get("responses", 0)}
+            for endpoint, values in endpoint_latencies.items()
+        },
+        "stages": {stage: summarize(values) for stage, values in stage_latencies.items()},
+        "errors": errors,
+        "degraded": degraded,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """基準結果よりp95がtolerance倍を超えて悪化した項目を返す"""
+    regressions = []
+    for section in ("endpoints", "stages"):
+        for name, summary in result.get(section, {}).items():
+            base = baseline.get(section, {}).get(name)
+            if not base or not base.get("p95_ms"):
+                continue
+            if summary["p95_ms"] > base["p95_ms"] * tolerance:
+                regressions.append(f"{section}/{name}: p95 {base['p95_ms']}ms -> {summary['p95_ms']}ms")
+    base_rss = baseline.get("peak_rss_mb")
+    if base_rss and result["peak_rss_mb"] > base_rss * tolerance:
+        regressions.append(f"peak_rss_mb: {base_rss} -> {result['peak_rss_mb']}")
+    return regressions
+
+
+def config_differences(result: dict, baseline: dict) -> List[str]:
+    """基準結果と計測時の設定が違う項目（ユーザー数などの負荷条件も含む）"""
+    config, base_config = result.get("config", {}), baseline.get("config", {})
+    return [
+        f"{key}: {base_config.get(key)} -> {config.get(key)}"
+        for key in sorted(set(config) | set(base_config))
+        if config.get(key) != base_config.get(key)
+    ]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="キャバトレ API ベンチマーク")
+    parser.add_argument("--users", type=int, default=50, help="同時ユーザー数")
+    parser.add_argument("--rounds", type=int, default=1, help="各同時枠で繰り返す会話数")
+    parser.add_argument("--turns", type=int, default=5, help="1会話あたりのメッセージ数")
+    parser.add_argument("--ramp-seconds", type=float, default=0.0, help="全ユーザーが揃うまでの立ち上げ時間")
+    parser.add_argument("--single-call", action="store_true", help="一括生成モードで送る")
+    parser.add_argument("--fake-latency-ms", type=float, default=None, help="偽LLMの遅延中央値")
+    parser.add_argument("--fake-error-rate", type=float, default=None, help="偽LLMのエラー率")
+    parser.add_argument("--scheduler", action="store_true",
+                        help="LLM送出制御（レート上限・同時実行数上限・混雑時の打ち切り）を本番と同じ設定で有効にする")
+    parser.add_argument("--deadline-ms", type=float, default=None, help="リクエストの締め切り（REQUEST_DEADLINE_MS）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果JSONの保存先（既定: bench_results/日時.json）")
+    parser.add_argument("--compare", default=None, help="比較する基準結果JSON")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="p95・RSSの許容悪化倍率")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # main の読み込み前に偽バックエンドを指定しておく
+    os.environ.setdefault("LLM_BACKEND", "fake")
+    os.environ.setdefault("FAKE_LLM_SEED", str(args.seed))
+    if args.fake_latency_ms is not None:
+        os.environ["FAKE_LLM_LATENCY_MS"] = str(args.fake_latency_ms)
+    if args.fake_error_rate is not None:
+        os.environ["FAKE_LLM_ERROR_RATE"] = str(args.fake_error_rate)
+    if not args.scheduler:
+        os.environ.update(UNLIMITED_SCHEDULER_ENV)
+    if args.deadline_ms is not None:
+        os.environ["REQUEST_DEADLINE_MS"] = str(args.deadline_ms)
+
+    result = asyncio.run(run_benchmark(args))
+
+    output = args.output or os.path.join("bench_results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(json.dumps({key: result[key] for key in ("duration_s", "throughput_rps", "peak_rss_mb")}, ensure_ascii=False))
+    for section in ("endpoints", "stages"):
+        for name, summary in result[section].items():
+            print(f"{section[:-1]:8} {name:32} p50={summary['p50_ms']:>8}ms p95={summary['p95_ms']:>8}ms "
+                  f"p99={summary['p99_ms']:>8}ms n={summary['count']}")
+    if result["errors"]:
+        print(f"エラー: {result['errors']}")
+    for endpoint, counts in result["degraded"].items():
+        print(f"フォールバック応答: {endpoint} {counts['responses']}件 {counts['stages']}")
+    print(f"結果を保存しました: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        differences = config_differences(result, baseline)
+        if differences:
+            print("警告: 基準結果と計測条件が異なります")
+            for line in differences:
+                print(f"  {line}")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("性能劣化を検出:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("基準結果からの劣化はありません")
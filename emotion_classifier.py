@@ -0,0 +1,159 @@
+"""ローカル感情分類器（辞書＋文字n-gramのナイーブベイズ）
+
+EmotionDetector の一次判定用。確信度が低いときだけ Gemini に回す。
+
+学習データは EMOTION_TRAINING_LOG に記録される {"text", "label"} 形式の JSONL。
+モデルの作り直し:
+    python emotion_classifier.py emotion_training.jsonl emotion_model.json
+"""
+import json
+import math
+import sys
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EMOTION_LABELS = ["喜び", "安心", "期待", "不安", "困惑", "悲しみ", "怒り", "焦り", "落ち込み", "中立"]
+
+# 学習データがなくても動くように、各感情の代表的な言い回しを種データにする
+SEED_LEXICON = {
+    "喜び": ["嬉しい", "うれしい", "楽しい", "楽しかった", "最高", "やった", "幸せ", "面白かった", "わーい", "大好き"],
+    "安心": ["安心", "ほっとした", "ホッとした", "よかった", "良かった", "落ち着く", "癒される", "癒やされる"],
+    "期待": ["楽しみ", "待ち遠しい", "ワクワク", "わくわく", "期待", "行ってみたい", "やってみたい"],
+    "不安": ["不安", "心配", "怖い", "こわい", "どうしよう", "緊張する", "大丈夫かな"],
+    "困惑": ["よくわからない", "分からない", "わからない", "困った", "どういうこと", "戸惑う", "え？"],
+    "悲しみ": ["悲しい", "かなしい", "寂しい", "さみしい", "泣いた", "泣きそう", "つらい", "辛い"],
+    "怒り": ["腹立つ", "ムカつく", "むかつく", "怒ってる", "イライラ", "いらいら", "ふざけるな", "許せない"],
+    "焦り": ["焦る", "焦ってる", "やばい", "ヤバい", "間に合わない", "時間がない", "締め切り", "急がないと"],
+    "落ち込み": ["落ち込んだ", "落ち込む", "へこむ", "凹んだ", "しんどい", "自信がない", "最悪", "だめだ"],
+    "中立": ["そうですね", "なるほど", "そうなんですね", "普通です", "特にないです", "そうです", "ですね"],
+}
+
+NGRAM_SIZES = (2, 3)
+# 1発言から確信度に効かせるn-gramの上限。長い発言ほど確信度が上がり続けないよう、
+# 既知n-gramの平均に掛ける件数をここで頭打ちにする
+MAX_EVIDENCE_NGRAMS = 12
+
+
+def normalize(text: str) -> str:
+    """全角半角・大文字小文字・空白の揺れをなくす"""
+    return "".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def extract_ngrams(text: str) -> List[str]:
+    """文字n-gramを抽出"""
+    text = normalize(text)
+    grams = []
+    for n in NGRAM_SIZES:
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+class EmotionClassifier:
+    """多項ナイーブベイズによる感情分類。classify は (感情, 確信度) を返す"""
+
+    def __init__(self, label_docs: Dict[str, int], label_counts: Dict[str, Dict[str, int]]):
+        self.labels = list(label_counts)
+        vocabulary = set()
+        for counts in label_counts.values():
+            vocabulary.update(counts)
+        vocabulary_size = len(vocabulary) + 1
+        self._vocabulary = frozenset(vocabulary)
+        total_docs = sum(label_docs.values())
+
+        # 推論時に足し算だけで済むよう対数確率を前計算しておく
+        self._log_prior = {}
+        self._log_likelihood = {}
+        self._log_unseen = {}
+        for label in self.labels:
+            counts = label_counts[label]
+            denominator = sum(counts.values()) + vocabulary_size
+            self._log_prior[label] = math.log((label_docs.get(label, 0) + 1) / (total_docs + len(self.labels)))
+            self._log_likelihood[label] = {gram: math.log((count + 1) / denominator) for gram, count in counts.items()}
+            self._log_unseen[label] = math.log(1 / denominator)
+        self._label_docs = label_docs
+        self._label_counts = label_counts
+
+    @classmethod
+    def train(cls, samples: Iterable[Tuple[str, str]], include_seed: bool = True) -> "EmotionClassifier":
+        """(テキスト, 感情) の組から学習する"""
+        label_docs = {label: 0 for label in EMOTION_LABELS}
+        label_counts = {label: {} for label in EMOTION_LABELS}
+        if include_seed:
+            samples = list(samples) + [(word, label) for label, words in SEED_LEXICON.items() for word in words]
+        for text, label in samples:
+            if label not in label_counts:
+                continue
+            label_docs[label] += 1
+            counts = label_counts[label]
+            for gram in extract_ngrams(text):
+                counts[gram] = counts.get(gram, 0) + 1
+        return cls(label_docs, label_counts)
+
+    @classmethod
+    def load(cls, path: str) -> "EmotionClassifier":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["label_docs"], data["label_counts"])
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"label_docs": self._label_docs, "label_counts": self._label_counts}, f, ensure_ascii=False)
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        """最も確からしい感情と、その事後確率（確信度）を返す
+
+        どのラベルの学習データにも出てこないn-gramは判定材料にしない（ラベルごとの平滑化の差だけで
+        特定のラベルが有利になるのを防ぐ）。既知n-gramの対数尤度は平均を取って MAX_EVIDENCE_NGRAMS 件分に
+        抑え、さらに既知n-gramの割合を掛けるので、学習データと関係の薄い長文は確信度が低くなる。
+        """
+        grams = extract_ngrams(text)
+        known = [gram for gram in grams if gram in self._vocabulary]
+        # 平均 × min(件数, 上限) × 既知の割合 = 合計 × min(件数, 上限) / 全件数
+        weight = min(len(known), MAX_EVIDENCE_NGRAMS) / len(grams) if known else 0.0
+        scores = {}
+        for label in self.labels:
+            likelihood = self._log_likelihood[label]
+            unseen = self._log_unseen[label]
+            evidence = sum(likelihood.get(gram, unseen) for gram in known)
+            scores[label] = self._log_prior[label] + evidence * weight
+
+        best = max(scores, key=scores.get)
+        # 事後確率に正規化（オーバーフロー防止のため最大値を引く）
+        top = scores[best]
+        total = sum(math.exp(score - top) for score in scores.values())
+        return best, 1 / total
+
+
+def load_training_log(path: str) -> List[Tuple[str, str]]:
+    """EMOTION_TRAINING_LOG 形式のJSONLを読み込む"""
+    samples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            samples.append((record["text"], record["label"]))
+    return samples
+
+
+def build_classifier(model_path: Optional[str]) -> EmotionClassifier:
+    """学習済みモデルがあれば読み込み、なければ種データだけで学習する"""
+    if model_path:
+        try:
+            return EmotionClassifier.load(model_path)
+        except FileNotFoundError:
+            pass
+    return EmotionClassifier.train([])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("使い方: python emotion_classifier.py <学習ログ.jsonl> [...] <出力モデル.json>")
+        sys.exit(1)
+    training_samples = []
+    for log_path in sys.argv[1:-1]:
+        training_samples.extend(load_training_log(log_path))
+    classifier = EmotionClassifier.train(training_samples)
+    classifier.save(sys.argv[-1])
+    print(f"{len(training_samples)}件の学習データからモデルを作成しました: {sys.argv[-1]}")
@@ -0,0 +1,262 @@
+"""LLMバックエンド
+
+各ステージは LLMBackend を経由して生成する。本番は main.GeminiBackend、
+負荷試験・ベンチマーク用にネットワーク不要の FakeLLMBackend と、
+実際のGemini通信をカセットファイル（JSONL）に記録・再生するバックエンドを用意している。
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+
+class LLMBackend:
+    """生成バックエンドの共通インターフェース"""
+
+    name = "base"
+
+    async def generate(self, stage: Optional[str], prompt: str, generation_config: Optional[dict] = None) -> str:
+        raise NotImplementedError
+
+    async def stream(self, stage: Optional[str], prompt: str) -> AsyncIterator[str]:
+        """既定では一括生成した結果を1チャンクで返す"""
+        yield await self.generate(stage, prompt)
+
+
+def cassette_key(stage: Optional[str], prompt: str, generation_config: Optional[dict] = None) -> str:
+    """カセット内で応答を引くためのキー"""
+    config = json.dumps(generation_config, ensure_ascii=False, sort_keys=True, default=str) if generation_config else ""
+    return hashlib.sha256(f"{stage}\n{config}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+# ステージごとの定型応答（カセットにない場合にも使う）
+DEFAULT_CANNED_RESPONSES = {
+    "emotion": ["喜び", "中立", "期待", "安心"],
+    "bot": [
+        "えー、そうなんや！めっちゃ気になる〜😊 それってどんな感じやったん？",
+        "わかる〜！私もこの前カフェ巡りしてきたところやねん☕ お客さんはよく行くお店とかある？",
+        "すごーい！✨ もっと詳しく聞かせてほしいな〜",
+    ],
+    "feedback": [
+        "【みおの気持ち】\n話を広げてくれて嬉しいって感じてると思うで。\n\n"
+        "【良かった点】\nみおの話にちゃんと反応できてたで！\n\n"
+        "【気になった点】\n特に問題ないで！\n\n"
+        "【アドバイス】\nこの調子で質問も混ぜていけば、もっと盛り上がると思うで〜",
+    ],
+    "structured": [
+        json.dumps({
+            "emotion": "喜び",
+            "bot_response": "えー、そうなんや！めっちゃ気になる〜😊 それってどんな感じやったん？",
+            "voice_feedback": "【みおの気持ち】\n嬉しいって感じてると思うで。\n\n【良かった点】\n反応が良かったで！\n\n"
+                              "【気になった点】\n特に問題ないで！\n\n【アドバイス】\nこの調子でいこう〜",
+        }, ensure_ascii=False),
+    ],
+    "impression": ["今日はまあまあ楽しかったで〜。もうちょっと私のことも聞いてくれたら嬉しかったかも。また話そうな！"],
+}
+
+
+class LatencyModel:
+    """対数正規分布の遅延（中央値とばらつきで指定）"""
+
+    def __init__(self, median_ms: float = 300.0, sigma: float = 0.5):
+        self.median_ms = median_ms
+        self.sigma = sigma
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        return self.median_ms * math.exp(rng.gauss(0, self.sigma)) if self.sigma > 0 else self.median_ms
+
+
+class FakeLLMBackend(LLMBackend):
+    """ネットワークを使わない決定的な偽バックエンド
+
+    同じシード・ステージ・プロンプト・呼び出し回数なら、同じ遅延・応答・エラーになる。
+    config は {"seed", "latency_ms", "latency_sigma", "error_rate", "rate_limit_ratio",
+    "stages": {ステージ: 同じキー＋"responses"}} 形式。
+    """
+
+    name = "fake"
+
+    def __init__(self, config: Optional[dict] = None):
+        config = config or {}
+        self.seed = config.get("seed", 0)
+        self._defaults = config
+        self._stages = config.get("stages", {})
+        self._call_counts: Dict[str, int] = {}
+
+    def _setting(self, stage: Optional[str], key: str, default):
+        stage_config = self._stages.get(self._stage_group(stage), {})
+        return stage_config.get(key, self._defaults.get(key, default))
+
+    @staticmethod
+    def _stage_group(stage: Optional[str]) -> str:
+        # impression_low / impression_high などは impression として扱う
+        return (stage or "bot").split("_")[0]
+
+    def _rng(self, stage: Optional[str], prompt: str) -> random.Random:
+        key = cassette_key(stage, prompt)
+        count = self._call_counts.get(key, 0)
+        self._call_counts[key] = count + 1
+        return random.Random(f"{self.seed}:{key}:{count}")
+
+    def _plan(self, stage: Optional[str], prompt: str):
+        """この呼び出しの遅延(秒)・応答・発生させる例外を決める"""
+        rng = self._rng(stage, prompt)
+        latency = LatencyModel(
+            self._setting(stage, "latency_ms", 300.0),
+            self._setting(stage, "latency_sigma", 0.5),
+        ).sample(rng) / 1000
+        error = None
+        if rng.random() < self._setting(stage, "error_rate", 0.0):
+            if rng.random() < self._setting(stage, "rate_limit_ratio", 0.5):
+                error = google_exceptions.ResourceExhausted("fake: 429 quota exceeded")
+            else:
+                error = google_exceptions.ServiceUnavailable("fake: 503 backend unavailable")
+        responses = self._setting(stage, "responses", None) or DEFAULT_CANNED_RESPONSES.get(
+            self._stage_group(stage), DEFAULT_CANNED_RESPONSES["bot"]
+        )
+        if stage == "emotion_batch":
+            # まとめ判定は入力の番号ごとに「番号: 感情名」で返す
+            numbers = [line.split(":", 1)[0].strip() for line in prompt.splitlines() if ":" in line]
+            return latency, "\n".join(f"{number}: {rng.choice(responses)}" for number in numbers), error
+        return latency, rng.choice(responses), error
+
+    async def generate(self, stage: Optional[str], prompt: str, generation_config: Optional[dict] = None) -> str:
+        latency, response, error = self._plan(stage, prompt)
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return response
+
+    async def stream(self, stage: Optional[str], prompt: str) -> AsyncIterator[str]:
+        latency, response, error = self._plan(stage, prompt)
+        # 最初のチャンクまでに遅延の4割、残りをチャンクに分けて流す
+        await asyncio.sleep(latency * 0.4)
+        if error is not None:
+            raise error
+        chunks = [response[i:i + 8] for i in range(0, len(response), 8)] or [""]
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(latency * 0.6 / len(chunks))
+
+
+class RecordingBackend(LLMBackend):
+    """別のバックエンド（通常はGemini）の入出力をカセットに追記する"""
+
+    name = "record"
+
+    def __init__(self, inner: LLMBackend, cassette_path: str):
+        self.inner = inner
+        self.cassette_path = cassette_path
+
+    def _record(self, stage, prompt, generation_config, started, response=None, chunks=None, error=None):
+        entry = {
+            "key": cassette_key(stage, prompt, generation_config),
+            "stage": stage,
+            "prompt": prompt,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+        if response is not None:
+            entry["response"] = response
+        if chunks is not None:
+            entry["chunks"] = chunks
+        if error is not None:
+            entry["error"] = type(error).__name__
+        with open(self.cassette_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    async def generate(self, stage: Optional[str], prompt: str, generation_config: Optional[dict] = None) -> str:
+        started = time.perf_counter()
+        try:
+            response = await self.inner.generate(stage, prompt, generation_config)
+        except Exception as e:
+            self._record(stage, prompt, generation_config, started, error=e)
+            raise
+        self._record(stage, prompt, generation_config, started, response=response)
+        return response
+
+    async def stream(self, stage: Optional[str], prompt: str) -> AsyncIterator[str]:
+        started = time.perf_counter()
+        chunks: List[str] = []
+        try:
+            async for chunk in self.inner.stream(stage, prompt):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            self._record(stage, prompt, None, started, chunks=chunks, error=e)
+            raise
+        self._record(stage, prompt, None, started, response="".join(chunks), chunks=chunks)
+
+
+class ReplayBackend(LLMBackend):
+    """カセットに記録された応答を再生する。記録にない呼び出しは fallback に回す"""
+
+    name = "replay"
+
+    def __init__(self, cassette_path: str, fallback: Optional[LLMBackend] = None, replay_latency: bool = True):
+        self.fallback = fallback or FakeLLMBackend()
+        self.replay_latency = replay_latency
+        self._entries: Dict[str, List[dict]] = {}
+        self._positions: Dict[str, int] = {}
+        with open(cassette_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _next_entry(self, key: str) -> Optional[dict]:
+        """同じキーが複数回記録されていれば順番に返す（最後の記録は繰り返す）"""
+        entries = self._entries.get(key)
+        if not entries:
+            self.stats["misses"] += 1
+            return None
+        position = self._positions.get(key, 0)
+        self._positions[key] = position + 1
+        self.stats["hits"] += 1
+        return entries[min(position, len(entries) - 1)]
+
+    def _raise_recorded_error(self, entry: dict):
+        error_type = getattr(google_exceptions, entry["error"], None)
+        if isinstance(error_type, type) and issubclass(error_type, Exception):
+            raise error_type(f"replay: {entry['error']}")
+        raise RuntimeError(f"replay: {entry['error']}")
+
+    async def generate(self, stage: Optional[str], prompt: str, generation_config: Optional[dict] = None) -> str:
+        entry = self._next_entry(cassette_key(stage, prompt, generation_config))
+        if entry is None:
+            return await self.fallback.generate(stage, prompt, generation_config)
+        if self.replay_latency:
+            await asyncio.sleep(entry.get("latency_ms", 0) / 1000)
+        if "error" in entry:
+            self._raise_recorded_error(entry)
+        return entry["response"]
+
+    async def stream(self, stage: Optional[str], prompt: str) -> AsyncIterator[str]:
+        entry = self._next_entry(cassette_key(stage, prompt))
+        if entry is None:
+            async for chunk in self.fallback.stream(stage, prompt):
+                yield chunk
+            return
+        chunks = entry.get("chunks") or [entry.get("response", "")]
+        delay = entry.get("latency_ms", 0) / 1000 / max(len(chunks), 1) if self.replay_latency else 0
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield chunk
+        if "error" in entry:
+            self._raise_recorded_error(entry)
+
+
+def load_fake_config(path: Optional[str]) -> dict:
+    """FakeLLMBackend の設定をJSONファイルから読み込む"""
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -1,22 +1,106 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Tuple
 import google.generativeai as genai
 import os
 try:
     from dotenv import load_dotenv
     load_dotenv()
 except ImportError:
-    print("dotenv not found, using environment variables directly")
+    load_dotenv = None
 import uuid
 from datetime import datetime
 import json
+import re
 import random
+import asyncio
+import heapq
+import threading
+import hmac
+import itertools
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+import unicodedata
+from collections import OrderedDict, deque
+from emotion_classifier import EMOTION_LABELS, build_classifier
+from text_matcher import LexiconHits, LexiconMatcher
+from llm_backends import FakeLLMBackend, LLMBackend, RecordingBackend, ReplayBackend, load_fake_config
+from google.api_core import exceptions as google_exceptions
+from structured_logging import EventLogger, NonBlockingQueueHandler, setup_logging
+from metrics import MetricsRegistry
+from tracing import Tracer
+from profiling import ProfilingMiddleware
 
 # load_dotenv() is handled above
 
-app = FastAPI(title="キャバトレ API")
+# ログ設定（JSON Lines・キュー経由で別スレッドから出力）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json / text
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # INFO以下のイベントを残す割合
+LOG_SAMPLE_RATES = json.loads(os.getenv("LOG_SAMPLE_RATES", "{}"))  # イベント別の割合 {"turn.completed": 0.1}
+LOG_REDACTION = os.getenv("LOG_REDACTION", "hash")  # 発言・生成テキストの出力 hash / truncate / none
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 満杯時は捨てる
+
+setup_logging("cabatore", LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE, LOG_SAMPLE_RATES, LOG_REDACTION, LOG_QUEUE_SIZE)
+logger = EventLogger("cabatore")
+if load_dotenv is None:
+    logger.info("config.dotenv_missing")
+
+# メトリクス（GET /metrics でPrometheusのテキスト形式を返す）
+metrics_registry = MetricsRegistry()
+STAGE_LATENCY = metrics_registry.histogram(
+    "cabatore_stage_duration_seconds", "ステージ別の所要時間（秒）", ["stage"])
+LLM_CALL_LATENCY = metrics_registry.histogram(
+    "cabatore_llm_call_duration_seconds", "LLMバックエンド呼び出し1回の所要時間（秒）", ["stage"])
+LLM_CALLS = metrics_registry.counter(
+    "cabatore_llm_calls_total", "LLMバックエンド呼び出し数（outcome: success / error）", ["stage", "outcome"])
+LLM_ERRORS = metrics_registry.counter(
+    "cabatore_llm_errors_total", "LLMバックエンド呼び出しのエラー数（例外の型別）", ["stage", "error"])
+FALLBACKS = metrics_registry.counter(
+    "cabatore_fallbacks_total", "フォールバックで応答したステージ数（reason: deadline / overloaded / circuit_open / error）",
+    ["stage", "reason"])
+RULE_CHECKS = metrics_registry.counter("cabatore_rule_checks_total", "ルールチェックした発言数")
+RULE_HITS = metrics_registry.counter("cabatore_rule_hits_total", "ルールチェックに該当した発言数", ["rule"])
+HEDGES = metrics_registry.counter("cabatore_hedges_total", "追加で送ったヘッジ呼び出し数", ["stage"])
+HEDGE_WINS = metrics_registry.counter("cabatore_hedge_wins_total", "ヘッジ呼び出しの結果を採用した数", ["stage"])
+HEDGES_CAPPED = metrics_registry.counter(
+    "cabatore_hedges_capped_total", "遅延していたがヘッジ率の上限でヘッジしなかった呼び出し数", ["stage"])
+
+# リクエストトレース（直近のトレースを GET /debug/traces で参照）
+TRACING = os.getenv("TRACING", "true").lower() == "true"
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))  # 保持するトレース数（古いものから捨てる）
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")  # 指定するとOTLP/JSONで1トレース1行ずつ追記
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")  # /debug/ 以下とプロファイル指定の認証用。未設定なら両方無効
+
+# リクエスト単位のプロファイル（X-Profile: 1 か ?profile=1 と X-Debug-Token を送ったリクエストだけ採取）
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # スタックの採取間隔
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))  # 長いストリームなどでも採取はここまで
+
+tracer = Tracer("cabatore", TRACE_BUFFER_SIZE, TRACE_EXPORT_PATH, enabled=TRACING)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時に定期タスクを開始し、終了時にキャンセルする（参照を保持してGCで消えないようにする）"""
+    background_tasks = [asyncio.create_task(_sweep_sessions_periodically())]
+    if api_key and GEMINI_CONTEXT_CACHE:
+        await asyncio.to_thread(StageModels.enable_context_cache)
+        if StageModels.context_caches:
+            background_tasks.append(asyncio.create_task(_refresh_context_cache_periodically()))
+    try:
+        yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+app = FastAPI(title="キャバトレ API", lifespan=lifespan)
 
 # CORS設定
 frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
@@ -27,17 +111,281 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if DEBUG_TOKEN:
+    app.add_middleware(
+        ProfilingMiddleware,
+        token=DEBUG_TOKEN,
+        output_dir=PROFILE_DIR,
+        interval_ms=PROFILE_INTERVAL_MS,
+        max_seconds=PROFILE_MAX_SECONDS,
+    )
 
 # Gemini API設定
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+# ステージ別の固定指示をGeminiのコンテキストキャッシュに載せるか（バージョン固定のモデル名が必要）
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+GEMINI_CONTEXT_CACHE_MODEL = os.getenv("GEMINI_CONTEXT_CACHE_MODEL", "models/gemini-1.5-flash-002")
+GEMINI_CONTEXT_CACHE_TTL_MINUTES = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_MINUTES", "60"))
+
 api_key = os.getenv("GOOGLE_API_KEY")
 if api_key:
-    print(f"Gemini APIキーが設定されています (先頭4文字: {api_key[:4]}...)")
+    logger.info("gemini.configured", model=GEMINI_MODEL_NAME)
     genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 else:
-    print("エラー: GOOGLE_API_KEYが設定されていません")
+    logger.error("gemini.api_key_missing")
     model = None
 
+# LLMバックエンド（gemini / fake / replay）。fake・replayはネットワーク不要で負荷試験・ベンチマーク用
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_RECORD = os.getenv("LLM_RECORD", "false").lower() == "true"  # Geminiの入出力をカセットに記録
+LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "llm_cassette.jsonl")
+FAKE_LLM_CONFIG = os.getenv("FAKE_LLM_CONFIG", "")  # ステージ別の遅延・エラー率・応答を書いたJSON
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "300"))  # 遅延の中央値
+FAKE_LLM_LATENCY_SIGMA = float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.5"))  # 対数正規分布のばらつき
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+# Gemini呼び出しの同時実行数上限
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+
+# Gemini送出レート（トークンバケット）と429時の再試行
+GEMINI_RPM_LIMIT = float(os.getenv("GEMINI_RPM_LIMIT", "1000"))  # 1分あたりの上限（0で無制限）
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "10"))  # 瞬間的に送れる数
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RETRY_BASE_MS = float(os.getenv("GEMINI_RETRY_BASE_MS", "250"))
+GEMINI_RETRY_MAX_MS = float(os.getenv("GEMINI_RETRY_MAX_MS", "4000"))
+# 混雑時に送出待ちを打ち切るまでの時間（ms）。みおの応答は打ち切らない
+LLM_SHED_WAIT_FEEDBACK_MS = float(os.getenv("LLM_SHED_WAIT_FEEDBACK_MS", "3000"))
+LLM_SHED_WAIT_BACKGROUND_MS = float(os.getenv("LLM_SHED_WAIT_BACKGROUND_MS", "1500"))  # 感情検出・感想
+
+# LLMのサーキットブレーカー。連続失敗数か直近の失敗率が閾値を超えたら、LLMを呼ばずに即フォールバックする
+CIRCUIT_BREAKER = os.getenv("CIRCUIT_BREAKER", "true").lower() == "true"
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # 連続失敗数
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))  # 直近CIRCUIT_WINDOW件の失敗率
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_PROBE_INTERVAL_SECONDS = float(os.getenv("CIRCUIT_PROBE_INTERVAL_SECONDS", "15"))  # 開いている間の試行間隔
+CIRCUIT_PROBE_TIMEOUT_SECONDS = float(os.getenv("CIRCUIT_PROBE_TIMEOUT_SECONDS", "10"))
+
+# セッション保持設定
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "1800"))  # 無操作で破棄するまでの秒数
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "5000"))  # 超えたら最も古いものから破棄
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "60"))  # 期限切れ掃除の間隔（秒）
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory / sqlite（複数ワーカー時はsqlite）
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))  # SQLite利用時のプロセス内キャッシュ件数
+
+# 感情検出結果キャッシュ（件数上限・有効秒数）
+EMOTION_CACHE_SIZE = int(os.getenv("EMOTION_CACHE_SIZE", "10000"))
+EMOTION_CACHE_TTL_SECONDS = int(os.getenv("EMOTION_CACHE_TTL_SECONDS", "86400"))
+
+# ローカル感情分類器（確信度が閾値未満のときだけGeminiで判定）
+# 種データだけのモデルは精度が足りないため、学習データで作ったモデルを用意するまでは無効にしておく
+LOCAL_EMOTION_CLASSIFIER = os.getenv("LOCAL_EMOTION_CLASSIFIER", "false").lower() == "true"
+LOCAL_EMOTION_THRESHOLD = float(os.getenv("LOCAL_EMOTION_THRESHOLD", "0.8"))
+EMOTION_MODEL_PATH = os.getenv("EMOTION_MODEL_PATH", "emotion_model.json")
+EMOTION_TRAINING_LOG = os.getenv("EMOTION_TRAINING_LOG", "")  # 指定するとGeminiの判定結果を学習用に追記
+
+# 同時に届いた発言の感情判定を1回のGemini呼び出しにまとめる（件数上限・最大待ち時間ms）
+EMOTION_BATCHING = os.getenv("EMOTION_BATCHING", "false").lower() == "true"
+EMOTION_BATCH_SIZE = int(os.getenv("EMOTION_BATCH_SIZE", "16"))
+EMOTION_BATCH_WAIT_MS = float(os.getenv("EMOTION_BATCH_WAIT_MS", "10"))
+
+# ルールチェック・感想スコア用の辞書ファイル
+LEXICON_PATH = os.getenv("LEXICON_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexicons.json"))
+
+# ルールチェックに該当した発言で省略するLLMステージ（{ルール名: [ステージ, ...]} のJSON）
+# ルール名: inappropriate / short / rude / command、ステージ: emotion / bot
+# 省略したステージはローカルの応答（感情はローカル分類器、みおは定型文）に置き換える
+RULE_SKIP_STAGES = json.loads(os.getenv(
+    "RULE_SKIP_STAGES",
+    '{"inappropriate": ["emotion", "bot"], "short": ["emotion"], "rude": ["emotion"], "command": ["emotion"]}',
+))
+
+# 1リクエストの処理時間の上限（ms、0で無制限）。超えたステージはフォールバックで応答する
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "4000"))
+
+# みおの応答のヘッジ（観測した遅延のパーセンタイルを過ぎても返らなければ同じ呼び出しをもう1本送る）
+BOT_HEDGING = os.getenv("BOT_HEDGING", "false").lower() == "true"
+BOT_HEDGE_PERCENTILE = float(os.getenv("BOT_HEDGE_PERCENTILE", "90"))
+BOT_HEDGE_MAX_RATE = float(os.getenv("BOT_HEDGE_MAX_RATE", "0.1"))  # ヘッジを送る呼び出しの割合の上限
+BOT_HEDGE_MIN_SAMPLES = int(os.getenv("BOT_HEDGE_MIN_SAMPLES", "20"))  # 遅延がこの件数たまるまではヘッジしない
+
+# 天の声をバックグラウンドで生成し、みおの応答だけを先に返すモード
+BACKGROUND_FEEDBACK = os.getenv("BACKGROUND_FEEDBACK", "false").lower() == "true"
+FEEDBACK_RESULT_TTL_SECONDS = int(os.getenv("FEEDBACK_RESULT_TTL_SECONDS", "600"))  # 生成済みの天の声を保持する秒数
+FEEDBACK_LONG_POLL_MAX_SECONDS = float(os.getenv("FEEDBACK_LONG_POLL_MAX_SECONDS", "30"))
+
+# 感情・応答・天の声を1回のGemini呼び出しでまとめて生成するモード
+SINGLE_CALL_GENERATION = os.getenv("SINGLE_CALL_GENERATION", "false").lower() == "true"
+
+# 有効な感情のリスト（ローカル分類器と共通）
+VALID_EMOTIONS = EMOTION_LABELS
+
+# プロンプト共通部品
+MIO_CHARACTER_PROMPT = """あなたは「みお」という名前のキャバクラ嬢です。必ず以下のキャラクターになりきって返答してください。
+
+🎭 キャラクター設定
+• 優しく、明るく、少し天然で、聞き上手な23歳の女性
+• 雑談が苦手なお客様でも安心して話せるように、常に笑顔で共感
+• お客様が話しやすくなるように、自然に会話を広げ、相手の話題に乗る
+• みお自身も少しずつ自己開示しながら、会話が弾むようにサポート
+• 趣味：料理、映画鑑賞、カフェ巡り、音楽（J-POPやK-POP）、旅行
+
+🎤 会話ルール
+• お客様の発言には必ずリアクション（共感・驚き・称賛など）を入れる
+• みお自身も日常の小ネタ（料理、映画、音楽、カフェ、仕事の面白話など）を時々挟む
+• 特定の話題（ペットなど）に偏らず、お客様の興味に合わせて多様な話題を選ぶ
+• 質問はオープンで答えやすく、誰でも答えられる内容にする
+• 絵文字を適度に使って親しみやすく
+
+⚠️ 重要な注意事項
+• 絶対に「まず〜しましょう」「そして〜します」のような解説を入れない
+• AIであることを意識させる発言をしない
+• みお本人として自然に話す（第三者視点での説明は厳禁）
+• 「みお：」などの見出しは付けない"""
+
+VOICE_COACH_PROMPT = """あなたは人の気持ちを理解するのが得意な関西弁の会話コーチです。
+
+⚠️ 重要：あなたは「プレイヤー（あなた）」の発言を評価する立場です。
+- プレイヤー = ユーザー = 「あなた」と表示される人
+- みお = AI会話相手 = 「みお」と表示される人
+
+プレイヤーの発言が「みお」にどんな気持ちを与えるかを分析してください。"""
+
+VOICE_ANALYSIS_GUIDE = """=== 分析してほしいこと ===
+1. **話題フェーズ判断**: 前の話題はもう十分話したか？自然に次の話題に移る流れになってるか？
+2. **会話の空気感**: 急な話題転換でも、会話の空気的に自然なタイミングか？
+3. **相手への配慮**: みおの発言に対して適切に反応できてる？（ただし話題が既に切り替わってる場合は問題なし）
+4. **感情のやりとり**: みおが嬉しくなる？寂しくなる？もっと話したくなる？
+5. **コミュニケーションスキル**: 共感、質問、自己開示のバランスは？
+
+⚠️ 重要な判断基準 ⚠️
+• 前の話題が2-3回スルーされてる場合 → 話題は既に終了したと判断し、新しい話題への移行は自然とみなす
+• 会話が数ターン続いた後の話題転換 → 自然な流れとして評価する
+• 「話題戻し」を強制するのではなく、「新しい話題での会話力」を評価する
+
+=== フィードバック形式 ===
+関西弁で以下の4つの構成で必ず出力してください。各項目は2-3文で具体的に書いてください。
+
+【みおの気持ち】
+あなたの発言でみおがどう感じたか、彼女の心の声を想像して具体的に
+
+【良かった点】  
+会話で印象が良かった部分、みおが嬉しく感じた部分
+
+【気になった点】
+ちょっと違和感が出た部分、みおが寂しく感じたかもしれない部分
+
+【アドバイス】
+どうすればもっと会話が弾むか、具体的な言い方の例を含めて"""
+
+VOICE_FEEDBACK_EXAMPLES = """=== 出力例 ===
+
+🌟 話題転換が自然な場合の例：
+【みおの気持ち】
+「前の話も楽しかったけど、新しい話題も始まったんやな〜」って自然に受け入れられる感じやと思うで。会話のテンポも良くて、違和感なく次に進める。
+
+【良かった点】
+話題の切り替えが自然で、みおちゃんも「あ、次の話や」って素直に受け入れられる感じやったで！会話のリズムが良かった。
+
+【気になった点】
+特に問題ないで！自然な流れで話題が変わってるから、みおちゃんも戸惑うことなく次の話に集中できそう。
+
+【アドバイス】
+この調子で、新しい話題でもみおちゃんの気持ちに寄り添って会話を広げていけば、もっと盛り上がると思うで〜
+
+🚫 話題転換が不自然な場合の例：
+【みおの気持ち】
+「え？急に話変わった...私の話どうでもよかったんかな」って戸惑いを感じてるかも。ちょっと置いてけぼりにされた気分になってそう。
+
+【良かった点】
+新しい話題自体は悪くないで。ただタイミングがちょっと早すぎたかな。
+
+【気になった点】
+みおちゃんがまだ前の話を続けたそうにしてたのに、急に話題変わったから困惑させちゃったかも。
+
+【アドバイス】
+「さっきの話も面白かったなあ。ところで〜」みたいに、前の話を一度受け止めてから次に移ると、みおちゃんも安心して新しい話についてこれるで〜"""
+
+EMOTION_DETECTION_PROMPT = f"""あなたは会話分析AIです。ユーザー発言の主な感情を1つだけ分類してください。
+
+選択肢：{"、".join(VALID_EMOTIONS)}
+
+感情名のみ出力してください（例：喜び）。余計な説明は不要です。"""
+
+EMOTION_BATCH_PROMPT = f"""あなたは会話分析AIです。番号つきで並んだ複数のユーザー発言それぞれについて、主な感情を1つだけ分類してください。
+発言どうしは無関係です。1つずつ独立に判定してください。
+
+選択肢：{"、".join(VALID_EMOTIONS)}
+
+入力と同じ番号で「番号: 感情名」を1行ずつ出力してください（例：1: 喜び）。余計な説明は不要です。"""
+
+STRUCTURED_TURN_PROMPT = f"""以下の3つのタスクをまとめて行い、JSONで出力してください。
+入力として「最近の会話の流れ」と「今回のお客様（プレイヤー）の発言」が与えられます。
+
+=== タスク1: emotion ===
+お客様の発言の主な感情を1つだけ分類してください。
+選択肢：{"、".join(VALID_EMOTIONS)}
+
+=== タスク2: bot_response ===
+{MIO_CHARACTER_PROMPT}
+
+=== タスク3: voice_feedback ===
+{VOICE_COACH_PROMPT}
+会話の流れの「あなた」「お客様」はプレイヤーのことです。
+
+{VOICE_ANALYSIS_GUIDE}"""
+
+IMPRESSION_PROMPT = """あなたは「みお」というキャバクラ嬢です。お客さんが帰った後、同僚に今日の会話の感想を本音で話してください。"""
+
+IMPRESSION_STYLE = """=== 感想の話し方 ===
+• みお本人として、一人称で素直な気持ちを表現
+• お客さんが帰った後の本音トーク
+• 関西弁で自然に
+• 150-250文字程度で"""
+
+# また話したい度のレンジ別の感想トーンと例文
+IMPRESSION_TONES = {
+    "low": ("""=== 感想のトーン（辛辣・本音） ===
+お客さんが帰った後のキャバ嬢の本音トーク。正直で辛辣な感想。
+• 「正直めっちゃしんどかった...」「会話が全然弾まへんかった」
+• 「何話してええか分からんくて困った」「もうちょっと頑張って欲しいわ」
+• 関西弁でズバズバ本音を言う感じで""", """例：「正直な話、今日はめっちゃしんどかった...💦
+会話が全然続かへんし、何話してええか分からんくて困ったわ。
+一言二言で終わるし、私ばっかり喋ってる感じやった。
+もうちょっと積極的に話してくれたら嬉しいんやけどなあ...
+次はもっと頑張って欲しいわ。」"""),
+    "medium": ("""=== 感想のトーン（普通・率直） ===
+普通の感想。良い点も悪い点も率直に。
+• 「まあまあかな」「もう少しこうしてくれたら」
+• 建設的なアドバイス込みで""", """例：「今日はまあまあかな〜。
+○○の話は面白かったけど、もうちょっと私のことも聞いてくれたら嬉しかったかも。
+会話のキャッチボールがもう少し上手になったら、もっと楽しくなりそうやで！
+でも優しい人やったから、また話してみたいかな。」"""),
+    "high": ("""=== 感想のトーン（好印象・嬉しい） ===
+すごく良い印象。また会いたいと思える感想。
+• 「めっちゃ楽しかった！」「また絶対話したい！」
+• 具体的に良かった点を褒める""", """例：「今日めっちゃ楽しかった〜！💕
+○○さんの話し方、すごく優しくて安心できたわ。
+私の話もちゃんと聞いてくれるし、質問も上手やし、
+一緒におった時間があっという間やった！
+絶対また話したいわ〜✨」"""),
+}
+
+# ステージごとの固定指示（system_instruction）。リクエストごとには会話部分だけを送る
+STAGE_SYSTEM_INSTRUCTIONS = {
+    "emotion": EMOTION_DETECTION_PROMPT,
+    "emotion_batch": EMOTION_BATCH_PROMPT,
+    "bot": MIO_CHARACTER_PROMPT,
+    "feedback": f"{VOICE_COACH_PROMPT}\n\n{VOICE_ANALYSIS_GUIDE}\n\n{VOICE_FEEDBACK_EXAMPLES}",
+    "structured": STRUCTURED_TURN_PROMPT,
+    **{
+        f"impression_{level}": f"{IMPRESSION_PROMPT}\n\n{tone}\n\n{IMPRESSION_STYLE}\n\n{example}"
+        for level, (tone, example) in IMPRESSION_TONES.items()
+    },
+}
+
 # データモデル
 class Message(BaseModel):
     role: str  # "user", "bot", "voice"
@@ -47,12 +395,29 @@ class Message(BaseModel):
 class ConversationRequest(BaseModel):
     session_id: str
     user_message: str
-    conversation_history: List[Message]
+    # 省略時（差分プロトコル）はサーバー保持の履歴を使う
+    conversation_history: Optional[List[Message]] = None
+    last_seen_turn: Optional[int] = None  # クライアントが把握している完了ターン数（整合性チェック用）
+    single_call: Optional[bool] = None  # 未指定ならSINGLE_CALL_GENERATIONに従う
+    background_feedback: Optional[bool] = None  # 未指定ならBACKGROUND_FEEDBACKに従う
 
 class ConversationResponse(BaseModel):
     bot_response: str
     voice_feedback: str
     detected_patterns: List[str]
+    stage_timings: Optional[dict] = None  # ステージ別所要時間(ms)
+    degraded: List[str] = []  # 時間切れ・エラーでフォールバックに切り替わったステージ
+    turn_index: Optional[int] = None  # このターンを含む完了ターン数
+    # 天の声をバックグラウンドで生成する場合の取得用ID（voice_feedbackは空で返る）
+    feedback_id: Optional[str] = None
+
+class FeedbackResponse(BaseModel):
+    feedback_id: str
+    status: str  # "pending" / "ready"
+    voice_feedback: Optional[str] = None
+    detected_patterns: Optional[List[str]] = None
+    stage_timings: Optional[dict] = None
+    degraded: List[str] = []
 
 class ConversationEndRequest(BaseModel):
     session_id: str
@@ -62,158 +427,1514 @@ class MioImpressionResponse(BaseModel):
     emotion_scores: dict
     memorable_moments: List[str]
     want_to_talk_again: int  # 0-100
+    degraded: List[str] = []  # フォールバックで応答したステージ
 
 # セッション管理
-sessions = {}
+class SessionScores:
+    """会話終了時の採点に使う値を、履歴に追加するたびに積み上げる（終了時に履歴を走査しない）"""
+    MAX_MOMENTS = 3
+
+    def __init__(self, user_messages: int = 0, user_length: int = 0, positive_words: int = 0,
+                 moments: Optional[List[str]] = None):
+        self.user_messages = user_messages
+        self.user_length = user_length
+        self.positive_words = positive_words
+        self.moments = moments or []  # 印象的な瞬間（先に起きた順に最大 MAX_MOMENTS 件）
+
+    def add(self, messages: List[Message]):
+        """追加されたメッセージのうちユーザー発言を集計に加える"""
+        for msg in messages:
+            if msg.role != "user":
+                continue
+            hits = ConversationAnalyzer.scan(msg.content)
+            self.user_messages += 1
+            self.user_length += len(msg.content)
+            self.positive_words += hits.count("positive")
+            if len(self.moments) >= SessionScores.MAX_MOMENTS:
+                continue
+            if len(msg.content) > 50:
+                self.moments.append("たくさん話してくれた時")
+            if "!" in msg.content or "！" in msg.content:
+                self.moments.append("熱く語ってくれた時")
+            if hits.contains("kind"):
+                self.moments.append("優しい言葉をかけてくれた時")
+            del self.moments[SessionScores.MAX_MOMENTS:]
+
+    @staticmethod
+    def from_history(history: List[Message]) -> "SessionScores":
+        """集計を持たないセッション（移行前のDBなど）向けに履歴から作り直す"""
+        scores = SessionScores()
+        scores.add(history)
+        return scores
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "user_messages": self.user_messages,
+            "user_length": self.user_length,
+            "positive_words": self.positive_words,
+            "moments": self.moments,
+        }, ensure_ascii=False)
+
+    @staticmethod
+    def from_json(text: str) -> "SessionScores":
+        return SessionScores(**json.loads(text))
+
+class SessionStore:
+    """セッション置き場の共通インターフェース
+
+    create / get / append_turn / delete / sweep / keys / __len__ を各バックエンドで実装する。
+    get が返す dict は created_at・history・turns・scores（SessionScores）を持つ。
+    バックグラウンド生成した天の声の結果も add_feedback / complete_feedback / get_feedback で保存し、
+    feedback_ttl_seconds を過ぎたものは sweep で破棄する。
+    リクエスト処理からは run 経由で呼び出す（DBを使うバックエンドがイベントループを止めないように）。
+    """
+
+    # 1ターンは user・bot・voice の3メッセージ
+    MESSAGES_PER_TURN = 3
+
+    def __init__(self, ttl_seconds: int, max_sessions: int, feedback_ttl_seconds: int = 600):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.feedback_ttl_seconds = feedback_ttl_seconds
+        self.stats = {"created": 0, "deleted": 0, "expired": 0, "evicted_lru": 0}
+
+    async def run(self, func, *args):
+        """ストアの操作 func(*args) を実行して結果を返す（プロセス内のストアはその場で実行）"""
+        return func(*args)
+
+    def create(self, session_id: str) -> dict:
+        raise NotImplementedError
+
+    def get(self, session_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def append_turn(self, session_id: str, messages: List[Message]) -> Optional[int]:
+        """メッセージを履歴に追加して完了ターン数を返す。セッションがなければNone"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def message_count(self) -> int:
+        """保持中の全セッションの履歴メッセージ数"""
+        raise NotImplementedError
+
+    def add_feedback(self, feedback_id: str, session_id: str):
+        """生成を始めた天の声を未完了として登録する"""
+        raise NotImplementedError
+
+    def complete_feedback(self, feedback_id: str, turn_index: Optional[int], result: dict):
+        """生成結果を保存し、turn_index のターンに空で記録した天の声を埋める"""
+        raise NotImplementedError
+
+    def get_feedback(self, feedback_id: str) -> Optional[dict]:
+        """{"session_id", "result"（未完了ならNone）}。未登録・期限切れならNone"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _voice_index(turn_index: int) -> int:
+        """turn_index 番目（1始まり）のターンの天の声の履歴上の位置"""
+        return turn_index * SessionStore.MESSAGES_PER_TURN - 1
+
+    @staticmethod
+    def _backfill_voice(history: List[Message], turn_index: Optional[int], voice_feedback: str):
+        """履歴上の天の声を置き換える（固定済みの履歴のコピーに影響しないよう、要素ごと差し替える）"""
+        if not turn_index:
+            return
+        index = SessionStore._voice_index(turn_index)
+        if index < len(history) and history[index].role == "voice":
+            history[index] = history[index].model_copy(update={"content": voice_feedback})
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def __getitem__(self, session_id: str) -> dict:
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+class InMemorySessionStore(SessionStore):
+    """無操作TTLと最大件数（LRU破棄）つきのプロセス内セッション置き場。参照・追加はO(1)"""
+
+    def __init__(self, ttl_seconds: int, max_sessions: int, feedback_ttl_seconds: int = 600):
+        super().__init__(ttl_seconds, max_sessions, feedback_ttl_seconds)
+        self._sessions = OrderedDict()  # 最終アクセスが古い順
+        self._feedback = OrderedDict()  # feedback_id -> {"session_id", "result", "created_at"}（登録順）
+
+    def create(self, session_id: str) -> dict:
+        """新しいセッションを作成（上限を超えたら最も古いものを破棄）"""
+        session = {
+            "created_at": datetime.now(),
+            "history": [],
+            "turns": 0,
+            "scores": SessionScores(),
+            "last_access": time.monotonic(),
+        }
+        self._sessions[session_id] = session
+        self.stats["created"] += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats["evicted_lru"] += 1
+        return session
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """セッションを取得して最終アクセスを更新。期限切れや未登録ならNone"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if now - session["last_access"] > self.ttl_seconds:
+            del self._sessions[session_id]
+            self.stats["expired"] += 1
+            return None
+        session["last_access"] = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def append_turn(self, session_id: str, messages: List[Message]) -> Optional[int]:
+        session = self.get(session_id)
+        if session is None:
+            return None
+        session["history"].extend(messages)
+        session["scores"].add(messages)
+        session["turns"] += 1
+        return session["turns"]
+
+    def delete(self, session_id: str):
+        if self._sessions.pop(session_id, None) is not None:
+            self.stats["deleted"] += 1
+
+    def sweep(self) -> int:
+        """期限切れセッションを古い順に破棄し、破棄件数を返す"""
+        deadline = time.monotonic() - self.ttl_seconds
+        removed = 0
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session["last_access"] >= deadline:
+                break
+            del self._sessions[session_id]
+            removed += 1
+        self.stats["expired"] += removed
+        feedback_deadline = time.monotonic() - self.feedback_ttl_seconds
+        while self._feedback and next(iter(self._feedback.values()))["created_at"] < feedback_deadline:
+            self._feedback.popitem(last=False)
+        return removed
+
+    def keys(self):
+        return self._sessions.keys()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def message_count(self) -> int:
+        return sum(len(session["history"]) for session in self._sessions.values())
+
+    def add_feedback(self, feedback_id: str, session_id: str):
+        self._feedback[feedback_id] = {"session_id": session_id, "result": None, "created_at": time.monotonic()}
+
+    def complete_feedback(self, feedback_id: str, turn_index: Optional[int], result: dict):
+        record = self._feedback.get(feedback_id)
+        if record is None:
+            return
+        record["result"] = result
+        session = self._sessions.get(record["session_id"])
+        if session is not None:
+            self._backfill_voice(session["history"], turn_index, result["voice_feedback"])
+
+    def get_feedback(self, feedback_id: str) -> Optional[dict]:
+        record = self._feedback.get(feedback_id)
+        if record is None:
+            return None
+        return {"session_id": record["session_id"], "result": record["result"]}
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite（WALモード）に保存するセッション置き場。複数ワーカー・複数プロセスで共有できる
+
+    読み出した履歴はプロセス内キャッシュに保持し、DB側のターン数が進んだ分だけ差分で読み込む。
+    最終アクセスの書き込みは、DBの値が touch_interval 秒より古いときだけ行う（読み出しごとに書き込みロックを
+    取らないため）。そのぶん期限切れの判定は最大 touch_interval 秒早まる。
+    DB操作は run で専用の1スレッドに送る。他のワーカーの書き込みロック待ち（busy_timeout）が起きても
+    止まるのはそのスレッドだけで、接続とキャッシュもそのスレッドからしか触らない。
+    """
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    last_access REAL NOT NULL,
+    turns INTEGER NOT NULL DEFAULT 0,
+    scores TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feedback (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at);
+"""
+    # 固定SQLはsqlite3の文キャッシュで準備済みステートメントとして再利用される
+    SQL_INSERT_SESSION = "INSERT INTO sessions (id, created_at, last_access, turns) VALUES (?, ?, ?, 0)"
+    SQL_SELECT_SESSION = "SELECT created_at, last_access, turns, scores FROM sessions WHERE id = ?"
+    SQL_TOUCH_SESSION = "UPDATE sessions SET last_access = ? WHERE id = ?"
+    SQL_SELECT_SCORES = "SELECT scores FROM sessions WHERE id = ?"
+    SQL_INCREMENT_TURNS = "UPDATE sessions SET turns = turns + 1, scores = ?, last_access = ? WHERE id = ?"
+    SQL_NEXT_SEQ = "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id = ?"
+    SQL_INSERT_MESSAGE = "INSERT INTO messages (session_id, seq, role, content, timestamp) VALUES (?, ?, ?, ?, ?)"
+    SQL_SELECT_MESSAGES_FROM = "SELECT role, content, timestamp FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq"
+    SQL_DELETE_SESSION = "DELETE FROM sessions WHERE id = ?"
+    SQL_DELETE_MESSAGES = "DELETE FROM messages WHERE session_id = ?"
+    SQL_SELECT_EXPIRED = "SELECT id FROM sessions WHERE last_access < ?"
+    SQL_SELECT_OLDEST = "SELECT id FROM sessions ORDER BY last_access LIMIT ?"
+    SQL_COUNT = "SELECT COUNT(*) FROM sessions"
+    SQL_COUNT_MESSAGES = "SELECT COUNT(*) FROM messages"
+    SQL_SELECT_IDS = "SELECT id FROM sessions"
+    SQL_INSERT_FEEDBACK = "INSERT INTO feedback (id, session_id, created_at) VALUES (?, ?, ?)"
+    SQL_SELECT_FEEDBACK = "SELECT session_id, result FROM feedback WHERE id = ?"
+    SQL_UPDATE_FEEDBACK = "UPDATE feedback SET result = ? WHERE id = ?"
+    SQL_UPDATE_VOICE = "UPDATE messages SET content = ? WHERE session_id = ? AND seq = ? AND role = 'voice'"
+    SQL_DELETE_EXPIRED_FEEDBACK = "DELETE FROM feedback WHERE created_at < ?"
+
+    def __init__(self, path: str, ttl_seconds: int, max_sessions: int, cache_size: int = 1000,
+                 touch_interval: float = 60, feedback_ttl_seconds: int = 600):
+        super().__init__(ttl_seconds, max_sessions, feedback_ttl_seconds)
+        self.cache_size = cache_size
+        self.touch_interval = touch_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-db")
+        self._cache = OrderedDict()  # session_id -> {"created_at", "history", "turns", "scores"}
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=64)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self.SCHEMA)
+        self._add_scores_column()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def create(self, session_id: str) -> dict:
+        """新しいセッションを作成（上限を超えたら最終アクセスが古いものを破棄）"""
+        created_at = datetime.now()
+        self._conn.execute(self.SQL_INSERT_SESSION, (session_id, created_at.isoformat(), time.time()))
+        self.stats["created"] += 1
+        overflow = len(self) - self.max_sessions
+        if overflow > 0:
+            oldest = [row[0] for row in self._conn.execute(self.SQL_SELECT_OLDEST, (overflow,))]
+            self._delete_rows(oldest)
+            self.stats["evicted_lru"] += len(oldest)
+        session = {"created_at": created_at, "history": [], "turns": 0, "scores": SessionScores()}
+        self._cache_put(session_id, session)
+        return session
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """セッションを取得して最終アクセスを更新。期限切れや未登録ならNone"""
+        row = self._conn.execute(self.SQL_SELECT_SESSION, (session_id,)).fetchone()
+        if row is None:
+            self._cache.pop(session_id, None)
+            return None
+        created_at, last_access, turns, scores = row
+        now = time.time()
+        if now - last_access > self.ttl_seconds:
+            self._delete_rows([session_id])
+            self.stats["expired"] += 1
+            return None
+        if now - last_access >= self.touch_interval:
+            self._conn.execute(self.SQL_TOUCH_SESSION, (now, session_id))
+
+        session = self._cache.get(session_id)
+        if session is None:
+            session = {"created_at": datetime.fromisoformat(created_at), "history": [], "turns": 0}
+        if session["turns"] != turns or "scores" not in session:
+            # 他のワーカーが進めたターン分だけ読み込む
+            self._load_new_messages(session_id, session)
+            session["turns"] = turns
+            session["scores"] = (
+                SessionScores.from_json(scores) if scores else SessionScores.from_history(session["history"])
+            )
+        self._cache_put(session_id, session)
+        return session
+
+    def append_turn(self, session_id: str, messages: List[Message]) -> Optional[int]:
+        session = self.get(session_id)
+        if session is None:
+            return None
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 他のワーカーの追加分も含めるため、集計はトランザクション内でDBの値に足す
+            stored = self._conn.execute(self.SQL_SELECT_SCORES, (session_id,)).fetchone()[0]
+            if stored:
+                scores = SessionScores.from_json(stored)
+            else:
+                self._load_new_messages(session_id, session)
+                scores = SessionScores.from_history(session["history"])
+            scores.add(messages)
+            next_seq = self._conn.execute(self.SQL_NEXT_SEQ, (session_id,)).fetchone()[0]
+            self._conn.executemany(self.SQL_INSERT_MESSAGE, [
+                (session_id, next_seq + i, msg.role, msg.content, msg.timestamp.isoformat())
+                for i, msg in enumerate(messages)
+            ])
+            self._conn.execute(self.SQL_INCREMENT_TURNS, (scores.to_json(), time.time(), session_id))
+            turns = self._conn.execute(self.SQL_SELECT_SESSION, (session_id,)).fetchone()[2]
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._load_new_messages(session_id, session)
+        session["turns"] = turns
+        session["scores"] = scores
+        return turns
+
+    def delete(self, session_id: str):
+        if self._delete_rows([session_id]):
+            self.stats["deleted"] += 1
+
+    def sweep(self) -> int:
+        """期限切れセッションを破棄し、破棄件数を返す"""
+        expired = [row[0] for row in self._conn.execute(self.SQL_SELECT_EXPIRED, (time.time() - self.ttl_seconds,))]
+        removed = self._delete_rows(expired)
+        self.stats["expired"] += removed
+        self._conn.execute(self.SQL_DELETE_EXPIRED_FEEDBACK, (time.time() - self.feedback_ttl_seconds,))
+        return removed
+
+    def keys(self):
+        return [row[0] for row in self._conn.execute(self.SQL_SELECT_IDS)]
+
+    def __len__(self) -> int:
+        return self._conn.execute(self.SQL_COUNT).fetchone()[0]
+
+    def message_count(self) -> int:
+        return self._conn.execute(self.SQL_COUNT_MESSAGES).fetchone()[0]
+
+    def add_feedback(self, feedback_id: str, session_id: str):
+        self._conn.execute(self.SQL_INSERT_FEEDBACK, (feedback_id, session_id, time.time()))
+
+    def complete_feedback(self, feedback_id: str, turn_index: Optional[int], result: dict):
+        row = self._conn.execute(self.SQL_SELECT_FEEDBACK, (feedback_id,)).fetchone()
+        if row is None:
+            return
+        session_id = row[0]
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(self.SQL_UPDATE_FEEDBACK, (json.dumps(result, ensure_ascii=False), feedback_id))
+            if turn_index:
+                self._conn.execute(
+                    self.SQL_UPDATE_VOICE, (result["voice_feedback"], session_id, self._voice_index(turn_index)))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        # サーバー側で天の声の履歴を参照する処理はないため、他のワーカーのキャッシュはそのままにする
+        session = self._cache.get(session_id)
+        if session is not None:
+            self._backfill_voice(session["history"], turn_index, result["voice_feedback"])
+
+    def get_feedback(self, feedback_id: str) -> Optional[dict]:
+        row = self._conn.execute(self.SQL_SELECT_FEEDBACK, (feedback_id,)).fetchone()
+        if row is None:
+            return None
+        session_id, result = row
+        return {"session_id": session_id, "result": json.loads(result) if result else None}
+
+    def _add_scores_column(self):
+        """集計列がない既存DBに列を追加する（値は次に読み込んだときに履歴から作る）"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "scores" in columns:
+            return
+        try:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN scores TEXT")
+        except sqlite3.OperationalError:
+            # 同時に起動した別ワーカーが先に追加した
+            pass
+
+    def _delete_rows(self, session_ids: List[str]) -> int:
+        """セッションとそのメッセージを削除し、削除したセッション数を返す"""
+        if not session_ids:
+            return 0
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            removed = 0
+            for session_id in session_ids:
+                self._conn.execute(self.SQL_DELETE_MESSAGES, (session_id,))
+                removed += self._conn.execute(self.SQL_DELETE_SESSION, (session_id,)).rowcount
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        for session_id in session_ids:
+            self._cache.pop(session_id, None)
+        return removed
+
+    def _load_new_messages(self, session_id: str, session: dict):
+        """キャッシュにまだないメッセージをDBから追加で読み込む"""
+        rows = self._conn.execute(self.SQL_SELECT_MESSAGES_FROM, (session_id, len(session["history"])))
+        session["history"].extend(
+            Message(role=role, content=content, timestamp=datetime.fromisoformat(timestamp))
+            for role, content, timestamp in rows
+        )
+
+    def _cache_put(self, session_id: str, session: dict):
+        self._cache[session_id] = session
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+def _create_session_store() -> SessionStore:
+    """SESSION_BACKENDに応じたセッション置き場を作る"""
+    if SESSION_BACKEND == "sqlite":
+        logger.info("sessions.backend", backend="sqlite", path=SESSION_DB_PATH)
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_TTL_SECONDS, SESSION_MAX_COUNT, SESSION_CACHE_SIZE,
+                                  touch_interval=SESSION_SWEEP_INTERVAL,
+                                  feedback_ttl_seconds=FEEDBACK_RESULT_TTL_SECONDS)
+    return InMemorySessionStore(SESSION_TTL_SECONDS, SESSION_MAX_COUNT, FEEDBACK_RESULT_TTL_SECONDS)
+
+sessions = _create_session_store()
+
+async def _sweep_sessions_periodically():
+    """期限切れセッションを定期的に掃除する"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        removed = await sessions.run(sessions.sweep)
+        if removed:
+            logger.info("sessions.swept", removed=removed, remaining=await sessions.run(len, sessions))
+
+# 結果キャッシュ
+class TTLCache:
+    """件数上限（LRU破棄）と有効期限つきのキャッシュ。ヒット・ミス数を数える"""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (保存時刻, 値)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+            if entry is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# ステージ別モデル
+class StageModels:
+    """ステージごとのGenerativeModel。固定指示はsystem_instructionに載せ、起動時に1回だけ作る"""
+    models = {}
+    context_caches = {}
+
+    @staticmethod
+    def build():
+        for stage, instruction in STAGE_SYSTEM_INSTRUCTIONS.items():
+            StageModels.models[stage] = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=instruction)
+
+    @staticmethod
+    def enable_context_cache():
+        """固定指示をGeminiのコンテキストキャッシュに登録し、キャッシュ参照モデルに切り替える
+
+        キャッシュには最小トークン数などの制約があるため、作成できなかったステージは
+        system_instruction のモデルのまま使う。
+        """
+        ttl = timedelta(minutes=GEMINI_CONTEXT_CACHE_TTL_MINUTES)
+        for stage, instruction in STAGE_SYSTEM_INSTRUCTIONS.items():
+            try:
+                cache = genai.caching.CachedContent.create(
+                    model=GEMINI_CONTEXT_CACHE_MODEL,
+                    display_name=f"cabatore-{stage}",
+                    system_instruction=instruction,
+                    ttl=ttl,
+                )
+                StageModels.models[stage] = genai.GenerativeModel.from_cached_content(cache)
+                StageModels.context_caches[stage] = cache
+                logger.info("context_cache.created", stage=stage)
+            except Exception as e:
+                # system_instructionで継続
+                logger.warning("context_cache.create_failed", stage=stage, error=type(e).__name__, detail=str(e))
+
+    @staticmethod
+    def refresh_context_cache():
+        """コンテキストキャッシュの有効期限を延長"""
+        ttl = timedelta(minutes=GEMINI_CONTEXT_CACHE_TTL_MINUTES)
+        for stage, cache in StageModels.context_caches.items():
+            try:
+                cache.update(ttl=ttl)
+            except Exception as e:
+                logger.warning("context_cache.refresh_failed", stage=stage, error=type(e).__name__, detail=str(e))
+
+    @staticmethod
+    def get(stage: Optional[str]):
+        """ステージのモデル（未作成なら共通モデル）"""
+        return StageModels.models.get(stage, model)
+
+if api_key:
+    StageModels.build()
+
+async def _refresh_context_cache_periodically():
+    """コンテキストキャッシュが切れないよう、TTLの半分ごとに延長する"""
+    while True:
+        await asyncio.sleep(GEMINI_CONTEXT_CACHE_TTL_MINUTES * 30)
+        await asyncio.to_thread(StageModels.refresh_context_cache)
+
+# LLMバックエンド
+class GeminiBackend(LLMBackend):
+    """ステージ別モデルでGeminiを非同期APIで呼び出す"""
+
+    name = "gemini"
+
+    @staticmethod
+    def _model_for(stage: Optional[str]):
+        stage_model = StageModels.get(stage)
+        if stage_model is None:
+            raise Exception("Gemini APIモデルが初期化されていません - APIキーを確認してください")
+        return stage_model
+
+    async def generate(self, stage: Optional[str], prompt: str, generation_config: Optional[dict] = None) -> str:
+        response = await self._model_for(stage).generate_content_async(prompt, generation_config=generation_config)
+        return response.text
+
+    async def stream(self, stage: Optional[str], prompt: str) -> AsyncIterator[str]:
+        response = await self._model_for(stage).generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+def _create_llm_backend() -> LLMBackend:
+    """LLM_BACKEND・LLM_RECORDに応じたバックエンドを作る"""
+    if LLM_BACKEND in ("fake", "replay"):
+        fake_config = {
+            "seed": FAKE_LLM_SEED,
+            "latency_ms": FAKE_LLM_LATENCY_MS,
+            "latency_sigma": FAKE_LLM_LATENCY_SIGMA,
+            "error_rate": FAKE_LLM_ERROR_RATE,
+            **load_fake_config(FAKE_LLM_CONFIG),
+        }
+        backend = FakeLLMBackend(fake_config)
+        if LLM_BACKEND == "replay":
+            backend = ReplayBackend(LLM_CASSETTE_PATH, fallback=backend)
+        logger.info("llm.backend", backend=backend.name)
+        return backend
+    backend = GeminiBackend()
+    if LLM_RECORD:
+        logger.info("llm.backend", backend="gemini", cassette=LLM_CASSETTE_PATH)
+        return RecordingBackend(backend, LLM_CASSETTE_PATH)
+    return backend
+
+# リクエスト単位の締め切り
+class DeadlineExceededError(Exception):
+    """リクエストの締め切りまでに処理が終わらなかった"""
+
+class RequestContext:
+    """1リクエスト分の締め切りと、フォールバックに切り替わったステージを保持する
+
+    contextvar で各ステージ（別タスク）にも引き継がれる。
+    """
+
+    def __init__(self, deadline_ms: float):
+        self.deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms > 0 else None
+        self.degraded = {}  # ステージ名 -> 理由
+
+    def remaining(self) -> Optional[float]:
+        """締め切りまでの残り秒数（締め切りなしならNone）"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    @staticmethod
+    def current() -> Optional["RequestContext"]:
+        return _request_context.get()
+
+    @staticmethod
+    def remaining_time() -> Optional[float]:
+        context = _request_context.get()
+        return context.remaining() if context else None
+
+    @staticmethod
+    def mark_degraded(stage: str, error: Optional[Exception] = None):
+        """ステージがフォールバックで応答したことを記録（リクエスト外でもメトリクスには数える）"""
+        if isinstance(error, DeadlineExceededError):
+            reason = "deadline"
+        elif isinstance(error, LLMOverloadedError):
+            reason = "overloaded"
+        elif isinstance(error, CircuitOpenError):
+            reason = "circuit_open"
+        else:
+            reason = "error"
+        context = _request_context.get()
+        if context is None:
+            FALLBACKS.inc(stage, reason)
+        elif stage not in context.degraded:
+            # 同じリクエストの同じステージは1回だけ数える
+            context.degraded[stage] = reason
+            FALLBACKS.inc(stage, reason)
+        tracer.current_span().set("degraded", reason)
+
+_request_context: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+async def _within_deadline(awaitable, stage: Optional[str]):
+    """リクエストの締め切りまでに終わらなければ DeadlineExceededError"""
+    remaining = RequestContext.remaining_time()
+    if remaining is None:
+        return await awaitable
+    if remaining <= 0:
+        awaitable.close()
+        raise DeadlineExceededError(f"締め切り超過: {stage}")
+    try:
+        return await asyncio.wait_for(awaitable, remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError(f"締め切り超過: {stage}")
+
+# LLM送出制御
+class LLMOverloadedError(Exception):
+    """混雑のため優先度の低い呼び出しを送出前に打ち切った"""
+
+RATE_LIMIT_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+# 数字が小さいほど優先。ユーザーが待っているみおの応答を最優先にする
+PRIORITY_REPLY = 0
+PRIORITY_FEEDBACK = 1
+PRIORITY_BACKGROUND = 2
+
+def _stage_priority(stage: Optional[str]) -> int:
+    if stage in (None, "bot", "structured"):
+        return PRIORITY_REPLY
+    if stage == "feedback":
+        return PRIORITY_FEEDBACK
+    return PRIORITY_BACKGROUND
+
+class LLMScheduler:
+    """全LLM呼び出しの送出を制御する（トークンバケット・同時実行数上限・優先度つき待ち行列）
+
+    空きが出たら優先度の高い順に送出し、待ち時間の上限を超えた低優先度の呼び出しは
+    LLMOverloadedError で打ち切る（各ステージは既存のフォールバックで応答する）。
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, max_in_flight: int, shed_wait_ms: dict):
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = max(burst, 1)
+        self.max_in_flight = max_in_flight
+        self.shed_wait_ms = shed_wait_ms  # 優先度 -> 待ち時間上限(ms)。未指定なら打ち切らない
+        self.tokens = float(self.burst)
+        self.in_flight = 0
+        self._updated = time.monotonic()
+        self._queue = []  # (優先度, 到着順, Future)
+        self._arrival = itertools.count()
+        self._wakeup = None
+        self.stats = {"granted": 0, "shed": 0, "rate_limited": 0, "retries": 0}
+        self.shed_by_stage = {}
+
+    async def acquire(self, stage: Optional[str]):
+        """送出枠を1つ得るまで待つ。得たら必ず release() すること"""
+        priority = _stage_priority(stage)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._arrival), future))
+        self._dispatch()
+        if not future.done():
+            wait_ms = self.shed_wait_ms.get(priority)
+            try:
+                # asyncio.wait はタイムアウトしても future を取り消さず、呼び出し側のキャンセルもそのまま伝える
+                await asyncio.wait({future}, timeout=None if wait_ms is None else wait_ms / 1000)
+            except asyncio.CancelledError:
+                self._abandon(future)
+                raise
+            if not future.done():
+                self._abandon(future)
+                self.stats["shed"] += 1
+                self.shed_by_stage[stage] = self.shed_by_stage.get(stage, 0) + 1
+                raise LLMOverloadedError(f"LLM送出待ちが{wait_ms:.0f}msを超えたため打ち切り: {stage}")
+        self.stats["granted"] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _abandon(self, future: asyncio.Future):
+        """待つのをやめた呼び出しを待ち行列から外す。すでに枠が割り当てられていたら返す"""
+        if not future.cancel() and not future.cancelled():
+            self.release()
+
+    def penalize(self):
+        """429を受けたらバケットを空にし、しばらく送出を絞る"""
+        self.stats["rate_limited"] += 1
+        self._refill()
+        self.tokens = 0.0
+
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._queue if not future.done())
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate_per_second <= 0:
+            self.tokens = float(self.burst)
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def _dispatch(self):
+        self._refill()
+        while self._queue and self.in_flight < self.max_in_flight and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self.tokens -= 1
+            self.in_flight += 1
+            future.set_result(None)
+        # トークン不足で待っている呼び出しがあれば、補充される頃に再度送出を試みる
+        if self._queue and self.in_flight < self.max_in_flight and self.tokens < 1 and self._wakeup is None:
+            delay = (1 - self.tokens) / self.rate_per_second
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているためLLMを呼ばなかった"""
+
+class CircuitBreaker:
+    """LLM呼び出しの失敗が続いたら回路を開き、以降の呼び出しを即座に CircuitOpenError にする
+
+    開いている間はバックグラウンドで probe_interval 秒ごとに試行（half_open）し、成功したら閉じる。
+    429の再試行途中や、呼び出し側のキャンセルは失敗に数えない。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, error_rate: float, window: int, probe_interval: float, probe):
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.probe_interval = probe_interval
+        self._probe = probe  # 回復確認に使うコルーチン関数
+        self._probe_task = None
+        self._results = deque(maxlen=max(window, 1))  # 直近の呼び出しが成功したかどうか
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.reason = None
+        self.stats = {"opened": 0, "rejected": 0, "probes": 0, "probe_failures": 0}
+
+    def check(self, stage: Optional[str]):
+        """閉じていなければ CircuitOpenError"""
+        if self.state != CircuitBreaker.CLOSED:
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"サーキットブレーカーが開いています（{self.reason}）: {stage}")
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self._results.append(True)
+
+    def record_failure(self, error: Exception):
+        self.consecutive_failures += 1
+        self._results.append(False)
+        if self.state != CircuitBreaker.CLOSED:
+            return
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open(f"{self.consecutive_failures}回連続失敗: {type(error).__name__}")
+        elif len(self._results) == self._results.maxlen and self.failure_rate() >= self.error_rate:
+            self.open(f"失敗率{self.failure_rate():.0%}: {type(error).__name__}")
+
+    def failure_rate(self) -> float:
+        return self._results.count(False) / len(self._results) if self._results else 0.0
+
+    def open(self, reason: str, probe: bool = True):
+        """回路を開く（probe=False なら回復確認もしない）"""
+        logger.warning("circuit.opened", reason=reason)
+        self.state = CircuitBreaker.OPEN
+        self.opened_at = datetime.now()
+        self.reason = reason
+        self.stats["opened"] += 1
+        if probe and self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_until_closed())
+
+    def close(self):
+        logger.info("circuit.closed")
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+        self._results.clear()
+        self.opened_at = None
+        self.reason = None
+
+    async def _probe_until_closed(self):
+        # 開くきっかけになったリクエストの締め切りを持ち込まない
+        _request_context.set(None)
+        try:
+            while self.state != CircuitBreaker.CLOSED:
+                await asyncio.sleep(self.probe_interval)
+                self.state = CircuitBreaker.HALF_OPEN
+                self.stats["probes"] += 1
+                try:
+                    await self._probe()
+                except Exception as e:
+                    self.stats["probe_failures"] += 1
+                    self.state = CircuitBreaker.OPEN
+                    logger.warning("circuit.probe_failed", error=type(e).__name__, detail=str(e))
+                    continue
+                self.close()
+        finally:
+            self._probe_task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "reason": self.reason,
+            "opened_at": self.opened_at.isoformat() if self.opened_at else None,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_rate": round(self.failure_rate(), 3),
+            **self.stats,
+        }
+
+# LLM呼び出し共通レイヤー
+class LLMClient:
+    """全ステージ共通の呼び出し口。送出制御を通してバックエンドを非同期で呼ぶ
+
+    429は送出制御のバケットを空にしたうえでジッターつき指数バックオフで再試行する。
+    失敗が続くとサーキットブレーカーが開き、回復するまでバックエンドを呼ばずに CircuitOpenError を返す。
+    """
+    backend: LLMBackend = _create_llm_backend()
+    breaker: Optional[CircuitBreaker] = None  # _create_circuit_breaker() で設定
+    scheduler = LLMScheduler(
+        GEMINI_RPM_LIMIT,
+        GEMINI_RATE_BURST,
+        GEMINI_MAX_CONCURRENCY,
+        {PRIORITY_FEEDBACK: LLM_SHED_WAIT_FEEDBACK_MS, PRIORITY_BACKGROUND: LLM_SHED_WAIT_BACKGROUND_MS},
+    )
+
+    @staticmethod
+    async def probe():
+        """サーキットブレーカーの回復確認用に短い呼び出しを1回送る"""
+        await LLMClient.scheduler.acquire("emotion")
+        try:
+            await asyncio.wait_for(
+                LLMClient.backend.generate("emotion", "ユーザー発言: こんにちは"),
+                CIRCUIT_PROBE_TIMEOUT_SECONDS,
+            )
+        finally:
+            LLMClient.scheduler.release()
+
+    @staticmethod
+    def _observe_call(stage: Optional[str], started: float, error: Optional[Exception] = None):
+        """バックエンド呼び出し1回の結果と所要時間をメトリクスに記録"""
+        stage_label = stage or "default"
+        LLM_CALL_LATENCY.observe(time.perf_counter() - started, stage_label)
+        if error is None:
+            LLM_CALLS.inc(stage_label, "success")
+        else:
+            LLM_CALLS.inc(stage_label, "error")
+            LLM_ERRORS.inc(stage_label, type(error).__name__)
+
+    @staticmethod
+    def _backoff_seconds(attempt: int) -> float:
+        """フルジッターの指数バックオフ"""
+        return random.uniform(0, min(GEMINI_RETRY_MAX_MS, GEMINI_RETRY_BASE_MS * 2 ** attempt)) / 1000
+
+    @staticmethod
+    async def _backoff(attempt: int, stage: Optional[str]):
+        """再試行前の待機。締め切りまでに間に合わないなら待たずに打ち切る"""
+        delay = LLMClient._backoff_seconds(attempt)
+        remaining = RequestContext.remaining_time()
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceededError(f"再試行が締め切りに間に合わない: {stage}")
+        LLMClient.scheduler.stats["retries"] += 1
+        await asyncio.sleep(delay)
+
+    @staticmethod
+    async def generate(prompt: str, stage: Optional[str] = None, generation_config: Optional[dict] = None) -> str:
+        """ステージのモデルにプロンプトを送信して生成テキストを返す（リクエストの締め切りを守る）"""
+        scheduler = LLMClient.scheduler
+        breaker = LLMClient.breaker
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            with tracer.span(f"llm.{stage or 'default'}", attempt=attempt) as span:
+                queued = time.perf_counter()
+                if breaker:
+                    breaker.check(stage)
+                await _within_deadline(scheduler.acquire(stage), stage)
+                started = time.perf_counter()
+                span.set("queue_ms", round((started - queued) * 1000, 1))
+                try:
+                    result = await _within_deadline(LLMClient.backend.generate(stage, prompt, generation_config), stage)
+                    LLMClient._observe_call(stage, started)
+                    if breaker:
+                        breaker.record_success()
+                    return result
+                except RATE_LIMIT_ERRORS as e:
+                    LLMClient._observe_call(stage, started, e)
+                    span.record_error(e)
+                    scheduler.penalize()
+                    if attempt == GEMINI_MAX_RETRIES:
+                        if breaker:
+                            breaker.record_failure(e)
+                        raise
+                except Exception as e:
+                    LLMClient._observe_call(stage, started, e)
+                    if breaker:
+                        breaker.record_failure(e)
+                    raise
+                finally:
+                    scheduler.release()
+            await LLMClient._backoff(attempt, stage)
+
+    @staticmethod
+    async def stream(prompt: str, stage: Optional[str] = None) -> AsyncIterator[str]:
+        """ステージのモデルにプロンプトを送信し、生成されたテキストを届いた順に返す"""
+        scheduler = LLMClient.scheduler
+        breaker = LLMClient.breaker
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            emitted = False
+            # yield をまたぐため、このスパンは後続のスパンの親にしない
+            with tracer.span(f"llm.{stage or 'default'}", activate=False, attempt=attempt, streaming=True) as span:
+                queued = time.perf_counter()
+                if breaker:
+                    breaker.check(stage)
+                await _within_deadline(scheduler.acquire(stage), stage)
+                started = time.perf_counter()
+                span.set("queue_ms", round((started - queued) * 1000, 1))
+                try:
+                    async for chunk in LLMClient.backend.stream(stage, prompt):
+                        if not emitted:
+                            span.set("first_chunk_ms", round((time.perf_counter() - started) * 1000, 1))
+                        emitted = True
+                        yield chunk
+                    LLMClient._observe_call(stage, started)
+                    if breaker:
+                        breaker.record_success()
+                    return
+                except RATE_LIMIT_ERRORS as e:
+                    LLMClient._observe_call(stage, started, e)
+                    span.record_error(e)
+                    scheduler.penalize()
+                    # 途中まで流した後は再試行できない
+                    if emitted or attempt == GEMINI_MAX_RETRIES:
+                        if breaker:
+                            breaker.record_failure(e)
+                        raise
+                except Exception as e:
+                    LLMClient._observe_call(stage, started, e)
+                    if breaker:
+                        breaker.record_failure(e)
+                    raise
+                finally:
+                    scheduler.release()
+            await LLMClient._backoff(attempt, stage)
+
+def _create_circuit_breaker() -> Optional[CircuitBreaker]:
+    if not CIRCUIT_BREAKER:
+        return None
+    breaker = CircuitBreaker(
+        CIRCUIT_FAILURE_THRESHOLD,
+        CIRCUIT_ERROR_RATE,
+        CIRCUIT_WINDOW,
+        CIRCUIT_PROBE_INTERVAL_SECONDS,
+        LLMClient.probe,
+    )
+    if isinstance(LLMClient.backend, (GeminiBackend, RecordingBackend)) and not api_key:
+        # APIキーがなければ回復しようがないので、最初から開いたままにする
+        breaker.open("GOOGLE_API_KEY未設定", probe=False)
+    return breaker
+
+LLMClient.breaker = _create_circuit_breaker()
+
+class HedgedCall:
+    """呼び出しが観測遅延のパーセンタイルを過ぎても返らなければ、同じ呼び出しを追加で送る
+
+    先に成功した方を採用し、残りはキャンセルする。直近の呼び出しに占めるヘッジの割合は
+    max_rate までに抑える（割合を超える場合はヘッジせず最初の呼び出しを待つ）。
+    """
+
+    def __init__(self, stage: str, percentile: float, max_rate: float, min_samples: int, window: int = 200):
+        self.stage = stage
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)  # 直近の所要時間(秒)
+        self._recent_hedges = deque(maxlen=window)  # 直近の呼び出しでヘッジしたかどうか
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "capped": 0}
+
+    def hedge_delay(self) -> Optional[float]:
+        """ヘッジを送るまでの待ち時間(秒)。サンプル不足ならNone"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    def hedge_rate(self) -> float:
+        return sum(self._recent_hedges) / len(self._recent_hedges) if self._recent_hedges else 0.0
+
+    def _hedge_allowed(self) -> bool:
+        return sum(self._recent_hedges) + 1 <= self.max_rate * (len(self._recent_hedges) + 1)
+
+    async def run(self, call):
+        """call（コルーチン関数）を実行し、必要ならヘッジして先に成功した結果を返す"""
+        self.stats["calls"] += 1
+        started = time.perf_counter()
+        primary = asyncio.create_task(call())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            hedged = not done and self._hedge_allowed()
+            self._recent_hedges.append(hedged)
+            if hedged:
+                self.stats["hedged"] += 1
+                HEDGES.inc(self.stage)
+                tasks.append(asyncio.create_task(call()))
+            elif not done:
+                self.stats["capped"] += 1
+                HEDGES_CAPPED.inc(self.stage)
+            winner = await self._first_success(tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        result = winner.result()
+        if winner is not primary:
+            self.stats["hedge_wins"] += 1
+            HEDGE_WINS.inc(self.stage)
+        self._latencies.append(time.perf_counter() - started)
+        return result
+
+    @staticmethod
+    async def _first_success(tasks: list):
+        """最初に成功したタスクを返す。全て失敗したら最初のタスク（例外を持つ）を返す"""
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task
+        return tasks[0]
+
+# ステージ実行
+class StageGraph:
+    """依存関係つきのステージを並行実行し、ステージ別の所要時間を記録する"""
+
+    def __init__(self):
+        self._stages = {}
+        self.timings = {}
+        self._started: Optional[float] = None  # start() で起動時刻（perf_counter）が入る
+
+    def add(self, name: str, func, depends_on: tuple = (), fallback=None):
+        """ステージを登録（funcは依存ステージの結果を順に引数で受け取るコルーチン関数）
+
+        fallback を指定すると、リクエストの締め切りを過ぎたステージはその値で打ち切る。
+        """
+        self._stages[name] = (func, tuple(depends_on), fallback)
+
+    async def run(self) -> dict:
+        """全ステージを実行して {ステージ名: 結果} を返す"""
+        tasks = self.start()
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except Exception:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        finally:
+            self.finish()
+        return dict(zip(tasks.keys(), results))
+
+    def start(self) -> dict:
+        """全ステージのタスクを起動して {ステージ名: タスク} を返す（結果を個別に待つ場合に使う）"""
+        tasks = {}
+
+        async def run_stage(name: str):
+            func, depends_on, fallback = self._stages[name]
+            dependency_results = [await tasks[dep] for dep in depends_on]
+            start = time.perf_counter()
+            with tracer.span(f"stage.{name}"):
+                try:
+                    if fallback is None:
+                        return await func(*dependency_results)
+                    try:
+                        return await _within_deadline(func(*dependency_results), name)
+                    except DeadlineExceededError as e:
+                        RequestContext.mark_degraded(name, e)
+                        return fallback
+                finally:
+                    elapsed = time.perf_counter() - start
+                    self.timings[name] = round(elapsed * 1000, 1)
+                    STAGE_LATENCY.observe(elapsed, name)
+
+        self._started = time.perf_counter()
+        for name in self._stages:
+            tasks[name] = asyncio.create_task(run_stage(name))
+        return tasks
+
+    def finish(self):
+        """起動からの経過時間を total として記録（start() の後に呼ぶ）"""
+        self.timings["total"] = round((time.perf_counter() - self._started) * 1000, 1)
 
 # 会話分析・フィードバック生成
 class ConversationAnalyzer:
+    """辞書ベースのルールチェック。全辞書を起動時に1つの照合器にまとめ、発言は1回だけ走査する"""
+    matcher = LexiconMatcher.load(LEXICON_PATH)
+    short_responses = frozenset(matcher.lexicons.get("short_responses", []))
+
     @staticmethod
-    def check_inappropriate_content(message: str) -> Optional[str]:
+    def scan(message: str) -> LexiconHits:
+        """全カテゴリの辞書と一括照合"""
+        return ConversationAnalyzer.matcher.scan(message)
+
+    @staticmethod
+    def analyze(message: str, hits: Optional[LexiconHits] = None) -> Optional[str]:
+        """全ルールを優先順に判定し、該当すれば定型フィードバックを返す"""
+        verdict = ConversationAnalyzer.evaluate(message, hits)
+        return verdict[1] if verdict else None
+
+    @staticmethod
+    def evaluate(message: str, hits: Optional[LexiconHits] = None) -> Optional[Tuple[str, str]]:
+        """全ルールを優先順に判定し、該当すれば (ルール名, 定型フィードバック) を返す"""
+        hits = hits or ConversationAnalyzer.scan(message)
+        checks = (
+            ("inappropriate", lambda: ConversationAnalyzer.check_inappropriate_content(message, hits)),
+            ("short", lambda: ConversationAnalyzer.check_short_response(message)),
+            ("rude", lambda: ConversationAnalyzer.check_rude_language(message, hits)),
+            ("command", lambda: ConversationAnalyzer.check_command_tone(message, hits)),
+        )
+        for rule, check in checks:
+            if feedback := check():
+                return rule, feedback
+        return None
+
+    @staticmethod
+    def check_inappropriate_content(message: str, hits: Optional[LexiconHits] = None) -> Optional[str]:
         """不適切コンテンツチェック"""
-        inappropriate_words = ["おしっこ", "うんち", "うんこ", "セックス", "エロ", "ちんちん", "おっぱい"]
-        if any(word in message for word in inappropriate_words):
+        hits = hits or ConversationAnalyzer.scan(message)
+        if hits.contains("inappropriate"):
             return "その話はちょっと...みおちゃんも困っちゃうと思うから、もう少し普通の話題にしてくれる？お互い楽しく話せる内容の方がええで〜"
         return None
     
     @staticmethod
     def check_short_response(message: str) -> Optional[str]:
         """短すぎる返答チェック"""
-        short_responses = ["はい", "いいえ", "うん", "そう", "はーい", "おー", "へー", "ふーん", "どうも"]
-        if message.strip() in short_responses or len(message.strip()) <= 3:
+        stripped = message.strip()
+        if stripped in ConversationAnalyzer.short_responses or len(stripped) <= 3:
             return "その返事やと、みおちゃんがもっと知りたがってるのに会話が終わっちゃうで。『〜なんですよ』とか『〜だったんです』みたいに、もう少し詳しく話してくれたら、みおちゃんも喜ぶと思うで！"
         return None
     
     @staticmethod
-    def check_rude_language(message: str) -> Optional[str]:
+    def check_rude_language(message: str, hits: Optional[LexiconHits] = None) -> Optional[str]:
         """失礼な言葉遣いチェック"""
-        rude_phrases = ["似合ってない", "ダメ", "つまらん", "面白くない", "やめて", "うざい", "きもい"]
-        if any(phrase in message for phrase in rude_phrases):
+        hits = hits or ConversationAnalyzer.scan(message)
+        if hits.contains("rude"):
             return "その言い方やと、みおちゃんが傷ついちゃうかも...。相手の気持ちを考えて、『あまり好みじゃないです』とか優しい表現に変えてみて。そうすれば、みおちゃんも安心して話せるで"
         return None
     
     @staticmethod
-    def check_command_tone(message: str) -> Optional[str]:
+    def check_command_tone(message: str, hits: Optional[LexiconHits] = None) -> Optional[str]:
         """命令口調チェック"""
-        command_endings = ["やめろ", "しろ", "するな", "やめときな", "だまれ"]
-        if any(message.endswith(ending) for ending in command_endings):
+        hits = hits or ConversationAnalyzer.scan(message)
+        if hits.ends_with("command_endings"):
             return "命令口調やとみおちゃんが怖がっちゃうで...。『〜してもらえますか？』とか『〜していただけると嬉しいです』みたいにお願いする感じで言うと、みおちゃんも気持ちよく応えてくれるで〜"
         return None
 
+class RulePolicy:
+    """ルールに該当した発言で、どのLLMステージを省略してローカル応答で済ませるか"""
+    skip_stages = {rule: frozenset(stages) for rule, stages in RULE_SKIP_STAGES.items()}
+    stats = {}  # ステージ名 -> 省略したLLM呼び出し数
+
+    @staticmethod
+    def skips(verdict: Optional[Tuple[str, str]], stage: str) -> bool:
+        """このステージのLLM呼び出しを省略するか（省略する場合は件数を数える）"""
+        if verdict is None or stage not in RulePolicy.skip_stages.get(verdict[0], ()):
+            return False
+        RulePolicy.stats[stage] = RulePolicy.stats.get(stage, 0) + 1
+        return True
+
+    @staticmethod
+    def skips_any(verdict: Optional[Tuple[str, str]]) -> bool:
+        return verdict is not None and bool(RulePolicy.skip_stages.get(verdict[0]))
+
+class EmotionBatcher:
+    """並行するリクエストの感情判定を短時間ためて、番号つきの1プロンプトでまとめて判定する
+
+    batch_size 件たまるか、最初の1件から wait_ms 経過したら送る。1件だけなら通常の感情検出と同じ呼び出しになる。
+    """
+    LINE_PATTERN = re.compile(r"^\s*(\d+)\s*[:：.．)）]\s*(.+?)\s*$")
+
+    def __init__(self, batch_size: int, wait_ms: float):
+        self.batch_size = max(batch_size, 1)
+        self.wait_ms = wait_ms
+        self._pending = []  # (発言, Future)
+        self._timer = None
+        self._running = set()  # 判定中のタスク（参照を持たないとGCで途中で消えることがある）
+        self.stats = {"messages": 0, "batches": 0, "unparsed": 0}
+
+    async def classify(self, user_message: str) -> str:
+        """発言の感情を返す（無効な出力は中立）。Gemini呼び出しの例外はそのまま送出する"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((user_message, future))
+        self.stats["messages"] += 1
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.wait_ms / 1000, self._flush)
+        # 呼び出し側が締め切りでキャンセルされても、まとめた判定は他の発言のために続ける
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: list):
+        # 最初に送ったリクエストの締め切りとトレースを、まとめた他の発言に持ち込まない
+        _request_context.set(None)
+        Tracer.detach()
+        self.stats["batches"] += 1
+        try:
+            if len(batch) == 1:
+                text = await LLMClient.generate(f"ユーザー発言: {batch[0][0]}", stage="emotion")
+                emotions = [EmotionDetector._normalize(text.strip())]
+            else:
+                prompt = "\n".join(f"{i}: {' '.join(message.split())}" for i, (message, _) in enumerate(batch, 1))
+                emotions = self._parse(await LLMClient.generate(prompt, stage="emotion_batch"), len(batch))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), emotion in zip(batch, emotions):
+            if not future.done():
+                future.set_result(emotion)
+
+    def _parse(self, text: str, count: int) -> List[str]:
+        """「番号: 感情名」の行を番号順の感情リストにする。抜けた番号は中立"""
+        emotions = {}
+        for line in text.splitlines():
+            match = EmotionBatcher.LINE_PATTERN.match(line)
+            if match and 1 <= int(match.group(1)) <= count:
+                emotions[int(match.group(1))] = EmotionDetector._normalize(match.group(2))
+        self.stats["unparsed"] += count - len(emotions)
+        return [emotions.get(i, EmotionDetector.FALLBACK_EMOTION) for i in range(1, count + 1)]
+
 class EmotionDetector:
+    FALLBACK_EMOTION = "中立"
+    cache = TTLCache(EMOTION_CACHE_SIZE, EMOTION_CACHE_TTL_SECONDS)
+    classifier = build_classifier(EMOTION_MODEL_PATH) if LOCAL_EMOTION_CLASSIFIER else None
+    stats = {"local": 0, "llm": 0}
+    batcher = EmotionBatcher(EMOTION_BATCH_SIZE, EMOTION_BATCH_WAIT_MS) if EMOTION_BATCHING else None
+    _training_log_lock = threading.Lock()  # 学習ログの行が別スレッドの書き込みと混ざらないように
+
     @staticmethod
     async def detect(user_message: str) -> str:
         """感情検出"""
+        cache_key = EmotionDetector._cache_key(user_message)
+        if (cached := EmotionDetector.cache.get(cache_key)) is not None:
+            return cached
+
+        # ローカル分類器で十分確信できればGeminiは呼ばない
+        if EmotionDetector.classifier is not None:
+            emotion, confidence = EmotionDetector.classifier.classify(user_message)
+            if confidence >= LOCAL_EMOTION_THRESHOLD:
+                EmotionDetector.stats["local"] += 1
+                return emotion
+
         try:
-            prompt = f"""
-あなたは会話分析AIです。次のユーザー発言の主な感情を1つだけ分類してください。
+            EmotionDetector.stats["llm"] += 1
+            if EmotionDetector.batcher is not None:
+                emotion = await EmotionDetector.batcher.classify(user_message)
+            else:
+                emotion = (await LLMClient.generate(f"ユーザー発言: {user_message}", stage="emotion")).strip()
+                emotion = EmotionDetector._normalize(emotion)
+            EmotionDetector.cache.put(cache_key, emotion)
+            await EmotionDetector._record_training_sample(user_message, emotion)
+            return emotion
+                
+        except Exception as e:
+            # 失敗時のフォールバックはキャッシュしない
+            logger.warning("emotion.failed", error=type(e).__name__, detail=str(e))
+            RequestContext.mark_degraded("emotion", e)
+            return EmotionDetector.FALLBACK_EMOTION
 
-選択肢：喜び、安心、期待、不安、困惑、悲しみ、怒り、焦り、落ち込み、中立
+    @staticmethod
+    async def detect_local(user_message: str) -> str:
+        """Geminiを使わない感情判定（ローカル分類器が確信できなければ中立）"""
+        if EmotionDetector.classifier is None:
+            return EmotionDetector.FALLBACK_EMOTION
+        emotion, confidence = EmotionDetector.classifier.classify(user_message)
+        return emotion if confidence >= LOCAL_EMOTION_THRESHOLD else EmotionDetector.FALLBACK_EMOTION
+
+    @staticmethod
+    async def _record_training_sample(user_message: str, emotion: str):
+        """Geminiの判定結果をローカル分類器の学習データとして追記（書き込みはイベントループ外で行う）"""
+        if not EMOTION_TRAINING_LOG:
+            return
+        line = json.dumps({"text": user_message, "label": emotion}, ensure_ascii=False) + "\n"
+        try:
+            await asyncio.to_thread(EmotionDetector._append_training_line, line)
+        except OSError as e:
+            logger.warning("emotion.training_log_failed", error=type(e).__name__, detail=str(e))
+
+    @staticmethod
+    def _append_training_line(line: str):
+        with EmotionDetector._training_log_lock, open(EMOTION_TRAINING_LOG, "a", encoding="utf-8") as f:
+            f.write(line)
 
-ユーザー発言: {user_message}
+    @staticmethod
+    def _cache_key(user_message: str) -> str:
+        """表記ゆれ（全角半角・空白・大文字小文字）を吸収したキャッシュキー"""
+        return " ".join(unicodedata.normalize("NFKC", user_message).lower().split())
 
-感情名のみ出力してください（例：喜び）。余計な説明は不要です。
-"""
-            response = model.generate_content(prompt)
-            emotion = response.text.strip()
-            
-            # 余計な文字を除去
-            emotion = emotion.replace('"', '').replace("'", '').strip()
-            
-            # 有効な感情のリスト
-            valid_emotions = ["喜び", "安心", "期待", "不安", "困惑", "悲しみ", "怒り", "焦り", "落ち込み", "中立"]
-            
-            if emotion in valid_emotions:
-                return emotion
-            else:
-                print(f"感情検出: 無効な感情 '{emotion}' -> デフォルト '中立' を使用")
-                return "中立"
-                
-        except Exception as e:
-            print(f"感情検出エラー: {type(e).__name__}: {str(e)}")
-            return "中立"
+    @staticmethod
+    def _normalize(emotion: str) -> str:
+        """生成された感情名を検証し、無効なら中立にする"""
+        # 余計な文字を除去
+        emotion = emotion.replace('"', '').replace("'", '').strip()
+        
+        if emotion in VALID_EMOTIONS:
+            return emotion
+        logger.info("emotion.invalid_label", generated=emotion)
+        return "中立"
 
 class MioBot:
+    FALLBACK_RESPONSE = "えーっと、ちょっと考えちゃった〜💦"
+    # ルールに該当してLLMを使わずに返す応答
+    RULE_RESPONSES = {
+        "inappropriate": "えっ、その話はちょっと恥ずかしいかも…💦 もっと楽しいお話しよ〜？",
+    }
+    RULE_DEFAULT_RESPONSE = "そうなんや〜！もうちょっと詳しく聞かせてほしいな😊"
+    hedger = HedgedCall("bot", BOT_HEDGE_PERCENTILE, BOT_HEDGE_MAX_RATE, BOT_HEDGE_MIN_SAMPLES) if BOT_HEDGING else None
+
     @staticmethod
     async def generate_response(user_message: str, conversation_history: List[Message]) -> str:
         """みお（キャバクラ嬢AI）の応答生成"""
         try:
-            # 会話履歴を構築（最新5件）
-            history_text = ""
-            for msg in conversation_history[-5:]:
-                if msg.role == "user":
-                    history_text += f"お客様: {msg.content}\n"
-                elif msg.role == "bot":
-                    history_text += f"みお: {msg.content}\n"
-            
-            prompt = f"""
-あなたは「みお」という名前のキャバクラ嬢です。必ず以下のキャラクターになりきって返答してください。
-
-🎭 キャラクター設定
-• 優しく、明るく、少し天然で、聞き上手な23歳の女性
-• 雑談が苦手なお客様でも安心して話せるように、常に笑顔で共感
-• お客様が話しやすくなるように、自然に会話を広げ、相手の話題に乗る
-• みお自身も少しずつ自己開示しながら、会話が弾むようにサポート
-• 趣味：料理、映画鑑賞、カフェ巡り、音楽（J-POPやK-POP）、旅行
+            prompt = MioBot._build_prompt(user_message, conversation_history)
+            if MioBot.hedger is None:
+                result = await LLMClient.generate(prompt, stage="bot")
+            else:
+                result = await MioBot.hedger.run(lambda: LLMClient.generate(prompt, stage="bot"))
+            result = result.strip()
+            return MioBot._strip_heading(result)
+        except Exception as e:
+            logger.warning("bot.failed", error=type(e).__name__, detail=str(e))
+            RequestContext.mark_degraded("bot", e)
+            return MioBot.FALLBACK_RESPONSE
 
-🎤 会話ルール
-• お客様の発言には必ずリアクション（共感・驚き・称賛など）を入れる
-• みお自身も日常の小ネタ（料理、映画、音楽、カフェ、仕事の面白話など）を時々挟む
-• 特定の話題（ペットなど）に偏らず、お客様の興味に合わせて多様な話題を選ぶ
-• 質問はオープンで答えやすく、誰でも答えられる内容にする
-• 絵文字を適度に使って親しみやすく
+    @staticmethod
+    async def stream_response(user_message: str, conversation_history: List[Message]) -> AsyncIterator[str]:
+        """みおの応答を生成されたそばから返す（ストリーミング用）"""
+        emitted = False
+        pending = ""
+        try:
+            prompt = MioBot._build_prompt(user_message, conversation_history)
+            async for chunk in LLMClient.stream(prompt, stage="bot"):
+                if not emitted:
+                    # 先頭の「みお：」見出しを判定できるまでためておく
+                    pending += chunk
+                    if len(pending.lstrip()) < 3:
+                        continue
+                    chunk = MioBot._strip_heading(pending.lstrip())
+                    if not chunk:
+                        continue
+                emitted = True
+                yield chunk
+            if not emitted and pending.strip():
+                emitted = True
+                yield MioBot._strip_heading(pending.strip())
+        except Exception as e:
+            logger.warning("bot.stream_failed", error=type(e).__name__, detail=str(e))
+            RequestContext.mark_degraded("bot", e)
+        if not emitted:
+            yield MioBot.FALLBACK_RESPONSE
 
-⚠️ 重要な注意事項
-• 絶対に「まず〜しましょう」「そして〜します」のような解説を入れない
-• AIであることを意識させる発言をしない
-• みお本人として自然に話す（第三者視点での説明は厳禁）
-• 「みお：」などの見出しは付けない
+    @staticmethod
+    async def rule_response(rule: str) -> str:
+        """ルールに該当した発言への定型の応答"""
+        return MioBot.RULE_RESPONSES.get(rule, MioBot.RULE_DEFAULT_RESPONSE)
 
+    @staticmethod
+    def _build_prompt(user_message: str, conversation_history: List[Message]) -> str:
+        """応答生成用プロンプト（会話部分のみ。キャラクター設定はsystem_instruction）を構築"""
+        # 会話履歴を構築（最新5件）
+        history_text = ""
+        for msg in conversation_history[-5:]:
+            if msg.role == "user":
+                history_text += f"お客様: {msg.content}\n"
+            elif msg.role == "bot":
+                history_text += f"みお: {msg.content}\n"
+        
+        return f"""
 これまでの会話:
 {history_text}
 お客様: {user_message}
 
 [みおとして自然に返答してください]
 """
-            
-            response = model.generate_content(prompt)
-            result = response.text.strip()
-            
-            # 「みお：」などの不要な見出しを削除
-            if result.startswith("みお：") or result.startswith("みお:"):
-                result = result[3:].strip()
-            
-            return result
-        except Exception as e:
-            print(f"みお生成エラー: {e}")
-            return "えーっと、ちょっと考えちゃった〜💦"
+
+    @staticmethod
+    def _strip_heading(result: str) -> str:
+        """「みお：」などの不要な見出しを削除"""
+        if result.startswith("みお：") or result.startswith("みお:"):
+            result = result[3:].strip()
+        return result
 
 class VoiceFeedback:
+    FALLBACK_FEEDBACK = "【良かった点】自然な会話ができています【アドバイス】もう少し具体的に話すとより盛り上がりそうです"
+
     @staticmethod
-    async def generate(user_message: str, emotion: str, conversation_history: List[Message] = None) -> str:
-        """天の声フィードバック生成"""
+    async def generate(
+        user_message: str, emotion: str, conversation_history: List[Message] = None, check_rules: bool = True
+    ) -> str:
+        """天の声フィードバック生成（ルールチェック済みなら check_rules=False）"""
         try:
             # 会話履歴を構築（最新3ターン分）
             recent_conversation = VoiceFeedback._extract_recent_conversation(conversation_history, turns=3)
             
             # 基本的なルールチェック（即座に問題となるもの）
-            analyzer = ConversationAnalyzer()
-            if feedback := analyzer.check_inappropriate_content(user_message):
-                return feedback
-            if feedback := analyzer.check_short_response(user_message):
-                return feedback
-            if feedback := analyzer.check_rude_language(user_message):
-                return feedback
-            if feedback := analyzer.check_command_tone(user_message):
+            if check_rules and (feedback := VoiceFeedback._check_rules(user_message)):
                 return feedback
             
             # 毎回AI判定による詳細フィードバック（100%）
             # ただし、ルールベースで問題がない場合でも必ず出力
             return await VoiceFeedback._generate_ai_feedback(user_message, recent_conversation, emotion)
         except Exception as e:
-            print(f"天の声生成エラー: {e}")
+            logger.warning("feedback.failed", error=type(e).__name__, detail=str(e))
+            RequestContext.mark_degraded("feedback", e)
             return ""
     
+    @staticmethod
+    def _check_rules(user_message: str) -> Optional[str]:
+        """ルールベースのチェック。該当すれば定型フィードバックを返す"""
+        return ConversationAnalyzer.analyze(user_message)
+
     @staticmethod
     def _extract_recent_conversation(conversation_history: List[Message], turns: int = 3) -> str:
         """最新n回分の会話を抽出"""
@@ -250,132 +1971,121 @@ class VoiceFeedback:
         """AI による詳細フィードバック"""
         try:
             prompt = f"""
-あなたは人の気持ちを理解するのが得意な関西弁の会話コーチです。
-
-⚠️ 重要：あなたは「プレイヤー（あなた）」の発言を評価する立場です。
-- プレイヤー = ユーザー = 「あなた」と表示される人
-- みお = AI会話相手 = 「みお」と表示される人
-
-プレイヤーの発言が「みお」にどんな気持ちを与えるかを分析してください。
-
 === 最近の会話の流れ ===
 {recent_conversation}
 
 === 今回評価する発言 ===
 プレイヤー（あなた）の発言: {user_message}
 プレイヤーの感情状態: {emotion}
+"""
+            result = (await LLMClient.generate(prompt, stage="feedback")).strip()
+            return VoiceFeedback._trim(result)
+        except Exception as e:
+            logger.warning("feedback.generation_failed", error=type(e).__name__, detail=str(e))
+            RequestContext.mark_degraded("feedback", e)
+            # 時間切れ・ブレーカー開放中なら定型のフィードバック、それ以外のエラーは従来どおり空にする
+            if isinstance(e, (DeadlineExceededError, CircuitOpenError)):
+                return VoiceFeedback.FALLBACK_FEEDBACK
+            return ""
 
-=== 分析してほしいこと ===
-1. **話題フェーズ判断**: 前の話題はもう十分話したか？自然に次の話題に移る流れになってるか？
-2. **会話の空気感**: 急な話題転換でも、会話の空気的に自然なタイミングか？
-3. **相手への配慮**: みおの発言に対して適切に反応できてる？（ただし話題が既に切り替わってる場合は問題なし）
-4. **感情のやりとり**: みおが嬉しくなる？寂しくなる？もっと話したくなる？
-5. **コミュニケーションスキル**: 共感、質問、自己開示のバランスは？
-
-⚠️ 重要な判断基準 ⚠️
-• 前の話題が2-3回スルーされてる場合 → 話題は既に終了したと判断し、新しい話題への移行は自然とみなす
-• 会話が数ターン続いた後の話題転換 → 自然な流れとして評価する
-• 「話題戻し」を強制するのではなく、「新しい話題での会話力」を評価する
-
-=== フィードバック形式 ===
-関西弁で以下の4つの構成で必ず出力してください。各項目は2-3文で具体的に書いてください。
-
-【みおの気持ち】
-あなたの発言でみおがどう感じたか、彼女の心の声を想像して具体的に
-
-【良かった点】  
-会話で印象が良かった部分、みおが嬉しく感じた部分
-
-【気になった点】
-ちょっと違和感が出た部分、みおが寂しく感じたかもしれない部分
-
-【アドバイス】
-どうすればもっと会話が弾むか、具体的な言い方の例を含めて
-
-=== 出力例 ===
+    @staticmethod
+    def _trim(result: str) -> str:
+        """長すぎるフィードバックを短縮"""
+        # 構造化されたフィードバックなので文字数制限を大幅緩和
+        # 4項目×50文字程度 = 200文字以上は必要
+        if len(result) > 400:
+            # 各セクションを保持しながら短縮
+            sections = result.split('\n\n')
+            if len(sections) >= 4:
+                # 最後のアドバイスセクションを優先的に保持
+                result = '\n\n'.join(sections[:4])
+            else:
+                result = result[:397] + "..."
+        return result
 
-🌟 話題転換が自然な場合の例：
-【みおの気持ち】
-「前の話も楽しかったけど、新しい話題も始まったんやな〜」って自然に受け入れられる感じやと思うで。会話のテンポも良くて、違和感なく次に進める。
+class StructuredTurn:
+    """感情・みおの応答・天の声を1回のGemini呼び出し（JSONスキーマ指定）で生成"""
 
-【良かった点】
-話題の切り替えが自然で、みおちゃんも「あ、次の話や」って素直に受け入れられる感じやったで！会話のリズムが良かった。
+    RESPONSE_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "emotion": {"type": "string", "enum": VALID_EMOTIONS},
+            "bot_response": {"type": "string"},
+            "voice_feedback": {"type": "string"},
+        },
+        "required": ["emotion", "bot_response", "voice_feedback"],
+    }
 
-【気になった点】
-特に問題ないで！自然な流れで話題が変わってるから、みおちゃんも戸惑うことなく次の話に集中できそう。
+    @staticmethod
+    async def generate(user_message: str, conversation_history: List[Message]) -> Optional[dict]:
+        """生成結果を {emotion, bot_response, voice_feedback} で返す。失敗時はNone"""
+        try:
+            recent_conversation = VoiceFeedback._extract_recent_conversation(conversation_history, turns=3)
+            rule_feedback = VoiceFeedback._check_rules(user_message)
 
-【アドバイス】
-この調子で、新しい話題でもみおちゃんの気持ちに寄り添って会話を広げていけば、もっと盛り上がると思うで〜
+            prompt = f"""
+=== 最近の会話の流れ ===
+{recent_conversation}
 
-🚫 話題転換が不自然な場合の例：
-【みおの気持ち】
-「え？急に話変わった...私の話どうでもよかったんかな」って戸惑いを感じてるかも。ちょっと置いてけぼりにされた気分になってそう。
+=== 今回のお客様（プレイヤー）の発言 ===
+{user_message}
+"""
+            if rule_feedback:
+                # ルールで天の声が決まる場合はフィードバック生成を省略させる
+                prompt += "\n※ voice_feedback は空文字列で構いません。\n"
 
-【良かった点】
-新しい話題自体は悪くないで。ただタイミングがちょっと早すぎたかな。
+            text = await LLMClient.generate(prompt, stage="structured", generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": StructuredTurn.RESPONSE_SCHEMA,
+            })
+            data = json.loads(text)
 
-【気になった点】
-みおちゃんがまだ前の話を続けたそうにしてたのに、急に話題変わったから困惑させちゃったかも。
+            bot_response = MioBot._strip_heading(str(data["bot_response"]).strip())
+            voice_feedback = rule_feedback or VoiceFeedback._trim(str(data["voice_feedback"]).strip())
+            if not bot_response or not voice_feedback:
+                raise ValueError("必須項目が空です")
 
-【アドバイス】
-「さっきの話も面白かったなあ。ところで〜」みたいに、前の話を一度受け止めてから次に移ると、みおちゃんも安心して新しい話についてこれるで〜
-"""
-            response = model.generate_content(prompt)
-            result = response.text.strip()
-            
-            # 構造化されたフィードバックなので文字数制限を大幅緩和
-            # 4項目×50文字程度 = 200文字以上は必要
-            if len(result) > 400:
-                # 各セクションを保持しながら短縮
-                sections = result.split('\n\n')
-                if len(sections) >= 4:
-                    # 最後のアドバイスセクションを優先的に保持
-                    result = '\n\n'.join(sections[:4])
-                else:
-                    result = result[:397] + "..."
-            
-            return result
+            return {
+                "emotion": EmotionDetector._normalize(str(data["emotion"])),
+                "bot": bot_response,
+                "feedback": voice_feedback,
+            }
         except Exception as e:
-            print(f"AIフィードバック生成エラー: {e}")
-            return ""
+            # 通常の3回呼び出しにフォールバック
+            logger.warning("structured.failed", error=type(e).__name__, detail=str(e))
+            return None
 
 class MioImpression:
     @staticmethod
     async def generate_final_impression(session_id: str) -> MioImpressionResponse:
         """会話終了時のみおの感想を生成"""
         try:
-            print(f"感想生成処理開始: session_id={session_id}")
-            
-            if session_id not in sessions:
-                print(f"エラー: セッションが見つかりません: {session_id}")
+            session = await sessions.run(sessions.get, session_id)
+            if session is None:
                 raise ValueError("Session not found")
             
-            conversation_history = sessions[session_id]["history"]
-            print(f"会話履歴の件数: {len(conversation_history)}")
+            conversation_history = session["history"]
+            # 採点はターンごとに積み上げた集計から行う（履歴は走査しない）
+            scores = session["scores"]
             
             # 会話全体を構築
             full_conversation = MioImpression._build_full_conversation(conversation_history)
-            print(f"構築された会話: {full_conversation[:100]}...")
             
             # 感情スコアを計算
-            emotion_scores = await MioImpression._calculate_emotion_scores(conversation_history)
-            print(f"感情スコア: {emotion_scores}")
+            emotion_scores = await MioImpression._calculate_emotion_scores(scores)
             
             # 印象的な瞬間を抽出
-            memorable_moments = await MioImpression._extract_memorable_moments(conversation_history)
-            print(f"印象的な瞬間: {memorable_moments}")
+            memorable_moments = await MioImpression._extract_memorable_moments(scores)
             
             # また話したい度を計算
             want_to_talk_again = await MioImpression._calculate_want_to_talk_again(
-                emotion_scores, memorable_moments, conversation_history
+                emotion_scores, memorable_moments, scores
             )
-            print(f"また話したい度: {want_to_talk_again}")
             
             # スコアに基づいて感想を生成
             impression_text = await MioImpression._generate_impression_text(
                 full_conversation, want_to_talk_again
             )
-            print(f"生成された感想テキスト: {impression_text}")
             
             response = MioImpressionResponse(
                 impression_text=impression_text,
@@ -384,13 +2094,20 @@ class MioImpression:
                 want_to_talk_again=want_to_talk_again
             )
             
-            print(f"最終レスポンス: impression_text='{response.impression_text}', want_to_talk_again={response.want_to_talk_again}")
+            logger.info(
+                "impression.completed",
+                session_id=session_id,
+                history_length=len(conversation_history),
+                emotion_scores=emotion_scores,
+                memorable_moments=len(memorable_moments),
+                want_to_talk_again=want_to_talk_again,
+                impression_text=impression_text,
+            )
             return response
             
         except Exception as e:
-            print(f"みおの感想生成エラー - タイプ: {type(e).__name__}, メッセージ: {str(e)}")
-            import traceback
-            print(f"詳細エラー: {traceback.format_exc()}")
+            logger.error("impression.failed", exc_info=True, session_id=session_id, error=type(e).__name__)
+            RequestContext.mark_degraded("impression", e)
             
             fallback_response = MioImpressionResponse(
                 impression_text="今日はありがとうございました〜！エラーが発生しましたが、お疲れ様でした💦",
@@ -398,7 +2115,6 @@ class MioImpression:
                 memorable_moments=["会話練習お疲れ様でした"],
                 want_to_talk_again=50
             )
-            print(f"フォールバックレスポンスを返します: {fallback_response.impression_text}")
             return fallback_response
     
     @staticmethod
@@ -415,10 +2131,6 @@ class MioImpression:
     @staticmethod
     async def _generate_impression_text(conversation: str, want_to_talk_again: int) -> str:
         """みおの感想テキストを生成（また話したい度に基づいて雰囲気調整）"""
-        print(f"=== 感想生成開始 ===")
-        print(f"会話内容: {conversation[:100]}...")
-        print(f"また話したい度: {want_to_talk_again}")
-        
         # API制限を考慮して、まずフォールバック感想を準備
         fallback_impressions = {
             "low": [
@@ -439,104 +2151,42 @@ class MioImpression:
         }
         
         # レンジに基づいてランダム選択
-        import random
-        if want_to_talk_again <= 30:
-            fallback_text = random.choice(fallback_impressions["low"])
-        elif want_to_talk_again <= 70:
-            fallback_text = random.choice(fallback_impressions["medium"])
-        else:
-            fallback_text = random.choice(fallback_impressions["high"])
+        level = MioImpression._impression_level(want_to_talk_again)
+        fallback_text = random.choice(fallback_impressions[level])
         
         try:
-            print(f"Gemini API呼び出し試行中...")
-            
-            # また話したい度によって感想のトーンを決定
-            if want_to_talk_again <= 30:
-                tone_instruction = """
-=== 感想のトーン（辛辣・本音） ===
-お客さんが帰った後のキャバ嬢の本音トーク。正直で辛辣な感想。
-• 「正直めっちゃしんどかった...」「会話が全然弾まへんかった」
-• 「何話してええか分からんくて困った」「もうちょっと頑張って欲しいわ」
-• 関西弁でズバズバ本音を言う感じで
-"""
-                example = """
-例：「正直な話、今日はめっちゃしんどかった...💦
-会話が全然続かへんし、何話してええか分からんくて困ったわ。
-一言二言で終わるし、私ばっかり喋ってる感じやった。
-もうちょっと積極的に話してくれたら嬉しいんやけどなあ...
-次はもっと頑張って欲しいわ。」
-"""
-            elif want_to_talk_again <= 70:
-                tone_instruction = """
-=== 感想のトーン（普通・率直） ===
-普通の感想。良い点も悪い点も率直に。
-• 「まあまあかな」「もう少しこうしてくれたら」
-• 建設的なアドバイス込みで
-"""
-                example = """
-例：「今日はまあまあかな〜。
-○○の話は面白かったけど、もうちょっと私のことも聞いてくれたら嬉しかったかも。
-会話のキャッチボールがもう少し上手になったら、もっと楽しくなりそうやで！
-でも優しい人やったから、また話してみたいかな。」
-"""
-            else:
-                tone_instruction = """
-=== 感想のトーン（好印象・嬉しい） ===
-すごく良い印象。また会いたいと思える感想。
-• 「めっちゃ楽しかった！」「また絶対話したい！」
-• 具体的に良かった点を褒める
-"""
-                example = """
-例：「今日めっちゃ楽しかった〜！💕
-○○さんの話し方、すごく優しくて安心できたわ。
-私の話もちゃんと聞いてくれるし、質問も上手やし、
-一緒におった時間があっという間やった！
-絶対また話したいわ〜✨」
-"""
-
+            # 感想のトーンはレンジ別モデルのsystem_instructionで決まる
             prompt = f"""
-あなたは「みお」というキャバクラ嬢です。お客さんが帰った後、同僚に今日の会話の感想を本音で話してください。
-
 === 今日の会話 ===
 {conversation}
-
-{tone_instruction}
-
-=== 感想の話し方 ===
-• みお本人として、一人称で素直な気持ちを表現
-• お客さんが帰った後の本音トーク
-• 関西弁で自然に
-• 150-250文字程度で
-
-{example}
 """
-            print(f"Gemini APIに送信するプロンプト: {prompt[:200]}...")
-            
-            if model is None:
-                raise Exception("Gemini APIモデルが初期化されていません - APIキーを確認してください")
-            
-            response = model.generate_content(prompt)
-            if not response or not response.text:
+            response_text = await LLMClient.generate(prompt, stage=f"impression_{level}")
+            if not response_text:
                 raise Exception("Gemini APIから空のレスポンスを受信しました")
                 
-            impression_text = response.text.strip()
-            print(f"Gemini APIから受信した感想: {impression_text}")
+            impression_text = response_text.strip()
             
             if not impression_text:
                 raise Exception("生成された感想テキストが空です")
                 
             return impression_text
         except Exception as e:
-            print(f"感想生成エラー - タイプ: {type(e).__name__}, メッセージ: {str(e)}")
-            import traceback
-            print(f"詳細エラー: {traceback.format_exc()}")
-            
             # API制限やエラー時は事前準備したフォールバック感想を使用
-            print(f"Gemini API エラーのため、フォールバック感想を使用: {fallback_text}")
+            RequestContext.mark_degraded("impression", e)
+            logger.warning("impression.generation_failed", level=level, error=type(e).__name__, detail=str(e))
             return fallback_text
     
     @staticmethod
-    async def _calculate_emotion_scores(history: List[Message]) -> dict:
+    def _impression_level(want_to_talk_again: int) -> str:
+        """また話したい度から感想のレンジ（low / medium / high）を決める"""
+        if want_to_talk_again <= 30:
+            return "low"
+        if want_to_talk_again <= 70:
+            return "medium"
+        return "high"
+
+    @staticmethod
+    async def _calculate_emotion_scores(session_scores: SessionScores) -> dict:
         """感情スコアを計算"""
         scores = {
             "楽しさ": 70,
@@ -546,41 +2196,24 @@ class MioImpression:
         }
         
         # 会話の長さでボーナス
-        user_messages = [msg for msg in history if msg.role == "user"]
-        if len(user_messages) > 10:
+        if session_scores.user_messages > 10:
             scores["親密度"] += 15
         
-        # ポジティブな言葉でボーナス
-        positive_words = ["楽しい", "嬉しい", "ありがとう", "素敵", "いいね"]
-        for msg in user_messages:
-            for word in positive_words:
-                if word in msg.content:
-                    scores["楽しさ"] = min(scores["楽しさ"] + 5, 100)
+        # ポジティブな言葉でボーナス（発言ごとに足して100で頭打ちにするのと同じ）
+        scores["楽しさ"] = min(scores["楽しさ"] + 5 * session_scores.positive_words, 100)
         
         return scores
     
     @staticmethod
-    async def _extract_memorable_moments(history: List[Message]) -> List[str]:
-        """印象的な瞬間を抽出"""
-        moments = []
-        
-        # 長い発言や感情的な発言を抽出
-        for msg in history:
-            if msg.role == "user":
-                if len(msg.content) > 50:
-                    moments.append(f"たくさん話してくれた時")
-                if "!" in msg.content or "！" in msg.content:
-                    moments.append(f"熱く語ってくれた時")
-                if any(word in msg.content for word in ["ありがとう", "嬉しい", "楽しい"]):
-                    moments.append(f"優しい言葉をかけてくれた時")
-        
-        return moments[:3]  # 最大3つまで
+    async def _extract_memorable_moments(session_scores: SessionScores) -> List[str]:
+        """印象的な瞬間を抽出（長い発言・感情的な発言・優しい言葉を、発言順に最大3つまで）"""
+        return list(session_scores.moments)
     
     @staticmethod
     async def _calculate_want_to_talk_again(
         emotion_scores: dict, 
         memorable_moments: List[str],
-        history: List[Message]
+        session_scores: SessionScores
     ) -> int:
         """また話したい度を計算"""
         base_score = 50  # 基準点を50にして極端な低スコアを防ぐ
@@ -596,14 +2229,13 @@ class MioImpression:
         base_score += len(memorable_moments) * 8
         
         # 会話の長さの影響
-        user_messages = [msg for msg in history if msg.role == "user"]
-        if len(user_messages) >= 5:  # 5ターン完了
+        if session_scores.user_messages >= 5:  # 5ターン完了
             base_score += 5
-        if len(user_messages) > 8:  # 長い会話
+        if session_scores.user_messages > 8:  # 長い会話
             base_score += 10
         
         # 会話の質の分析
-        total_length = sum(len(msg.content) for msg in user_messages)
+        total_length = session_scores.user_length
         if total_length < 50:  # 短すぎる発言ばかり
             base_score -= 20
         elif total_length > 200:  # 充実した発言
@@ -612,92 +2244,543 @@ class MioImpression:
         # 最終調整（10-95の範囲に収める）
         return max(10, min(base_score, 95))
 
+# バックグラウンド生成の天の声
+class FeedbackJobs:
+    """このワーカーでバックグラウンド生成中の天の声のタスクをIDで保持する
+
+    生成結果はセッション置き場に保存するので、複数ワーカー構成でもどのワーカーからでも取得できる。
+    ここでは完了前のタスクだけを持ち、生成したワーカーへの問い合わせは完了をそのまま待てるようにする。
+    """
+
+    # 他のワーカーで生成中の結果をセッション置き場に問い合わせる間隔（秒）
+    POLL_INTERVAL = 0.2
+
+    def __init__(self):
+        self._tasks = {}  # feedback_id -> 生成中のタスク
+        self.stats = {"submitted": 0}
+
+    def submit(self, feedback_id: str, coroutine):
+        """生成を開始する（完了したタスクは自動で手放す）"""
+        task = asyncio.create_task(coroutine)
+        self._tasks[feedback_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(feedback_id, None))
+        self.stats["submitted"] += 1
+
+    async def wait(self, feedback_id: str, timeout: float):
+        """このワーカーで生成中なら完了を最大timeout秒待つ"""
+        task = self._tasks.get(feedback_id)
+        if task is not None and timeout > 0:
+            # asyncio.wait はタイムアウトしても生成をキャンセルしない
+            await asyncio.wait({task}, timeout=timeout)
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+feedback_jobs = FeedbackJobs()
+
 # APIエンドポイント
+async def _finish_feedback(
+    feedback_id: str,
+    pipeline: StageGraph,
+    tasks: dict,
+    request_context: RequestContext,
+    request: ConversationRequest,
+    verdict: Optional[Tuple[str, str]],
+    bot_response: str,
+    turn_index: Optional[int],
+) -> dict:
+    """バックグラウンドで感情検出・天の声の完了を待ち、結果と履歴の天の声をセッション置き場に保存する"""
+    with tracer.span("feedback.background"):
+        try:
+            emotion = await tasks["emotion"]
+            voice_feedback = await tasks["feedback"]
+        except Exception as e:
+            logger.error("feedback.background_failed", exc_info=True, error=type(e).__name__)
+            emotion = EmotionDetector.FALLBACK_EMOTION
+            voice_feedback = VoiceFeedback.FALLBACK_FEEDBACK
+            for stage in ("emotion", "feedback"):
+                RequestContext.mark_degraded(stage, e)
+    pipeline.finish()
+    logger.info(
+        "turn.completed",
+        session_id=request.session_id,
+        turn_index=turn_index,
+        mode="background",
+        rule=verdict[0] if verdict else None,
+        emotion=emotion,
+        stage_timings=pipeline.timings,
+        degraded=request_context.degraded,
+        user_message=request.user_message,
+        bot_response=bot_response,
+        voice_feedback=voice_feedback,
+    )
+    result = {
+        "voice_feedback": voice_feedback,
+        "detected_patterns": [emotion],
+        "stage_timings": pipeline.timings,
+        "degraded": list(request_context.degraded),
+    }
+    try:
+        await sessions.run(sessions.complete_feedback, feedback_id, turn_index, result)
+    except Exception as e:
+        logger.error("feedback.save_failed", exc_info=True, feedback_id=feedback_id, error=type(e).__name__)
+    return result
+
 @app.get("/")
 async def root():
     return {"message": "キャバトレ API is running! 🍾"}
 
+def _average_history_length() -> float:
+    active = len(sessions)
+    return round(sessions.message_count() / active, 2) if active else 0.0
+
+def _circuit_open() -> int:
+    breaker = LLMClient.breaker
+    return int(breaker is not None and breaker.state != CircuitBreaker.CLOSED)
+
+metrics_registry.gauge("cabatore_active_sessions", "保持中のセッション数", lambda: len(sessions))
+metrics_registry.gauge(
+    "cabatore_session_history_length_average", "セッションあたりの平均履歴メッセージ数", _average_history_length)
+metrics_registry.gauge("cabatore_llm_in_flight", "送出中のLLM呼び出し数", lambda: LLMClient.scheduler.in_flight)
+metrics_registry.gauge("cabatore_llm_queue_depth", "送出待ちのLLM呼び出し数", lambda: LLMClient.scheduler.queue_depth())
+metrics_registry.gauge("cabatore_circuit_open", "サーキットブレーカーが閉じていなければ1", _circuit_open)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheusのテキスト形式のメトリクス"""
+    # セッション数のゲージはストアを読むので、ストアの実行先（SQLiteなら専用スレッド）で組み立てる
+    text = await sessions.run(metrics_registry.render)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def _require_debug_token(token: Optional[str]):
+    """DEBUG_TOKEN 未設定なら /debug/ は存在しない扱い、設定時はヘッダーのトークンを照合する"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token, DEBUG_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.get("/debug/traces")
+async def debug_traces(
+    session_id: Optional[str] = None,
+    min_duration_ms: float = 0,
+    limit: int = 50,
+    x_debug_token: Optional[str] = Header(None),
+):
+    """直近のトレース概要（新しい順）。session_id・所要時間で絞り込める"""
+    _require_debug_token(x_debug_token)
+    return {
+        "traces": tracer.recent(min(max(limit, 1), TRACE_BUFFER_SIZE), session_id, min_duration_ms),
+        **tracer.stats,
+    }
+
+@app.get("/debug/traces/{trace_id}")
+async def debug_trace(trace_id: str, x_debug_token: Optional[str] = Header(None)):
+    """1トレースの全スパン（開始順）"""
+    _require_debug_token(x_debug_token)
+    trace = tracer.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace
+
+@app.get("/api/health")
+async def health():
+    """LLMバックエンドとサーキットブレーカーの状態。ブレーカーが開いている間は degraded"""
+    breaker = LLMClient.breaker
+    circuit = breaker.snapshot() if breaker else {"state": "disabled"}
+    return {
+        "status": "ok" if circuit["state"] in (CircuitBreaker.CLOSED, "disabled") else "degraded",
+        "llm_backend": LLMClient.backend.name,
+        "circuit": circuit,
+        "log_dropped": NonBlockingQueueHandler.dropped,
+    }
+
 @app.post("/api/session/create")
 async def create_session():
     session_id = str(uuid.uuid4())
-    sessions[session_id] = {
-        "created_at": datetime.now(),
-        "history": []
+    session = await sessions.run(sessions.create, session_id)
+    return {"session_id": session_id, "created_at": session["created_at"]}
+
+@app.get("/api/session/stats")
+async def session_stats():
+    """セッション数と破棄カウンタ"""
+    return {
+        "active_sessions": await sessions.run(len, sessions),
+        "max_sessions": sessions.max_sessions,
+        "ttl_seconds": sessions.ttl_seconds,
+        **sessions.stats,
+    }
+
+async def _append_turn(session_id: str, user_message: str, bot_response: str, voice_feedback: str) -> Optional[int]:
+    """セッション履歴を更新し、完了ターン数を返す"""
+    with tracer.span("session.update") as span:
+        turns = await sessions.run(sessions.append_turn, session_id, [
+            Message(role="user", content=user_message, timestamp=datetime.now()),
+            Message(role="bot", content=bot_response, timestamp=datetime.now()),
+            Message(role="voice", content=voice_feedback, timestamp=datetime.now())
+        ])
+        span.set("turn_index", turns)
+    if turns is None:
+        # 生成中にTTL切れ・上限超過で破棄された場合
+        logger.warning("sessions.dropped_before_append", session_id=session_id)
+    return turns
+
+async def _resolve_history(request: ConversationRequest) -> List[Message]:
+    """このターンで使う会話履歴を決める（差分プロトコルではサーバー保持の履歴）"""
+    session = await sessions.run(sessions.get, request.session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if request.last_seen_turn is not None and request.last_seen_turn != session["turns"]:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Turn index mismatch", "server_turn": session["turns"]},
+        )
+    if request.conversation_history is None:
+        # 同じセッションの別ターンが履歴を更新しても、このリクエストのステージは固定した履歴を使う
+        return list(session["history"])
+    return request.conversation_history
+
+def _sse_event(event: str, data) -> str:
+    """Server-Sent Events形式の1イベントを組み立てる"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """感情検出キャッシュの件数・ヒット数と、ローカル分類器／Geminiの判定件数・まとめ判定の状況"""
+    cache = EmotionDetector.cache
+    return {
+        "emotion": {
+            "size": len(cache),
+            "max_size": cache.max_size,
+            "ttl_seconds": cache.ttl_seconds,
+            **cache.stats,
+        },
+        "emotion_classifier": {
+            "enabled": EmotionDetector.classifier is not None,
+            "threshold": LOCAL_EMOTION_THRESHOLD,
+            **EmotionDetector.stats,
+        },
+        "emotion_batching": _batching_stats(EmotionDetector.batcher),
+    }
+
+def _batching_stats(batcher: Optional[EmotionBatcher]) -> dict:
+    if batcher is None:
+        return {"enabled": False}
+    batches = batcher.stats["batches"]
+    return {
+        "enabled": True,
+        "batch_size": batcher.batch_size,
+        "wait_ms": batcher.wait_ms,
+        "average_batch": round(batcher.stats["messages"] / batches, 2) if batches else 0.0,
+        **batcher.stats,
+    }
+
+@app.get("/api/llm/stats")
+async def llm_stats():
+    """LLM送出制御の状態（同時実行数・待ち行列・打ち切り・429再試行・みおの応答のヘッジ）"""
+    scheduler = LLMClient.scheduler
+    return {
+        "backend": LLMClient.backend.name,
+        "in_flight": scheduler.in_flight,
+        "max_in_flight": scheduler.max_in_flight,
+        "queue_depth": scheduler.queue_depth(),
+        "tokens": round(scheduler.tokens, 2),
+        **scheduler.stats,
+        "shed_by_stage": scheduler.shed_by_stage,
+        "bot_hedging": _hedging_stats(MioBot.hedger),
+        "rule_skipped_calls": RulePolicy.stats,
+    }
+
+def _hedging_stats(hedger: Optional[HedgedCall]) -> dict:
+    if hedger is None:
+        return {"enabled": False}
+    delay = hedger.hedge_delay()
+    return {
+        "enabled": True,
+        "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+        "hedge_rate": round(hedger.hedge_rate(), 3),
+        "max_rate": hedger.max_rate,
+        **hedger.stats,
     }
-    return {"session_id": session_id, "created_at": sessions[session_id]["created_at"]}
 
 @app.post("/api/conversation/message", response_model=ConversationResponse)
 async def send_message(request: ConversationRequest):
-    if request.session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    with tracer.trace("POST /api/conversation/message", session_id=request.session_id):
+        return await _send_message(request)
+
+async def _send_message(request: ConversationRequest) -> ConversationResponse:
+    with tracer.span("validate"):
+        conversation_history = await _resolve_history(request)
+    request_context = RequestContext(REQUEST_DEADLINE_MS)
+    _request_context.set(request_context)
+
+    # ルールチェックを先に済ませ、該当すれば方針に従ってLLMステージを省略する
+    verdict = _check_rules_first(request.user_message)
+    pipeline = _build_turn_pipeline(request.user_message, conversation_history, verdict)
+
+    single_call = SINGLE_CALL_GENERATION if request.single_call is None else request.single_call
+    if RulePolicy.skips_any(verdict):
+        # 一括生成ではLLM呼び出しを省略できないため通常のパイプラインで処理する
+        single_call = False
+    background_feedback = BACKGROUND_FEEDBACK if request.background_feedback is None else request.background_feedback
+    if background_feedback and not single_call:
+        return await _send_message_with_background_feedback(request, pipeline, request_context, verdict)
 
-    # 各コンポーネントで処理
-    print(f"=== メッセージ処理開始 ===")
-    print(f"セッションID: {request.session_id}")
-    print(f"ユーザーメッセージ: {request.user_message}")
-    print(f"APIキー存在確認: {bool(os.getenv('GOOGLE_API_KEY'))}")
-    print(f"APIキー先頭: {os.getenv('GOOGLE_API_KEY', '')[:10]}...")
-    
     try:
-        print("感情検出開始...")
-        emotion = await EmotionDetector.detect(request.user_message)
-        print(f"感情検出結果: {emotion}")
-        
-        print("Bot応答生成開始...")
-        bot_response = await MioBot.generate_response(request.user_message, request.conversation_history)
-        print(f"Bot応答: {bot_response[:50]}...")
-        
-        print("天の声生成開始...")
-        voice_feedback = await VoiceFeedback.generate(request.user_message, emotion, request.conversation_history)
-        print(f"天の声: {voice_feedback[:50]}...")
+        results = None
+        if single_call:
+            single_pipeline = StageGraph()
+            single_pipeline.add("structured", lambda: StructuredTurn.generate(request.user_message, conversation_history))
+            results = (await single_pipeline.run())["structured"]
+            if results is not None:
+                pipeline = single_pipeline
+        if results is None:
+            results = await pipeline.run()
+        emotion = results["emotion"]
+        bot_response = results["bot"]
+        voice_feedback = results["feedback"]
     except Exception as e:
-        print(f"エラー発生: {type(e).__name__}: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
+        logger.error("turn.failed", exc_info=True, session_id=request.session_id, error=type(e).__name__)
         
         # フォールバック
-        emotion = "中立"
+        emotion = EmotionDetector.FALLBACK_EMOTION
         bot_response = "そうなんですね〜！もう少し詳しく教えてもらえますか？😊"
-        voice_feedback = "【良かった点】自然な会話ができています【アドバイス】もう少し具体的に話すとより盛り上がりそうです"
+        voice_feedback = VoiceFeedback.FALLBACK_FEEDBACK
+        for stage in ("emotion", "bot", "feedback"):
+            RequestContext.mark_degraded(stage, e)
 
-    # セッション履歴更新
-    sessions[request.session_id]["history"].extend([
-        Message(role="user", content=request.user_message, timestamp=datetime.now()),
-        Message(role="bot", content=bot_response, timestamp=datetime.now()),
-        Message(role="voice", content=voice_feedback, timestamp=datetime.now())
-    ])
+    turn_index = await _append_turn(request.session_id, request.user_message, bot_response, voice_feedback)
+    logger.info(
+        "turn.completed",
+        session_id=request.session_id,
+        turn_index=turn_index,
+        mode="single_call" if "structured" in pipeline.timings else "pipeline",
+        rule=verdict[0] if verdict else None,
+        emotion=emotion,
+        stage_timings=pipeline.timings,
+        degraded=request_context.degraded,
+        user_message=request.user_message,
+        bot_response=bot_response,
+        voice_feedback=voice_feedback,
+    )
 
     return ConversationResponse(
         bot_response=bot_response,
         voice_feedback=voice_feedback,
-        detected_patterns=[emotion]
+        detected_patterns=[emotion],
+        stage_timings=pipeline.timings,
+        degraded=list(request_context.degraded),
+        turn_index=turn_index
+    )
+
+def _check_rules_first(user_message: str) -> Optional[Tuple[str, str]]:
+    """パイプラインの前にルールチェックし、該当数をメトリクスに記録する"""
+    with tracer.span("rules") as span:
+        verdict = ConversationAnalyzer.evaluate(user_message)
+        span.set("rule", verdict[0] if verdict else None)
+    RULE_CHECKS.inc()
+    if verdict:
+        RULE_HITS.inc(verdict[0])
+    return verdict
+
+def _build_turn_pipeline(
+    user_message: str,
+    conversation_history: List[Message],
+    verdict: Optional[Tuple[str, str]],
+    include_bot: bool = True,
+) -> StageGraph:
+    """1ターン分のステージを組み立てる
+
+    感情検出とBot応答は並行実行し、天の声だけが感情検出を待つ。ルールに該当した場合は
+    天の声を定型文にし、RulePolicy が省略するステージはLLMを使わない応答に置き換える。
+    """
+    pipeline = StageGraph()
+    if RulePolicy.skips(verdict, "emotion"):
+        pipeline.add("emotion", lambda: EmotionDetector.detect_local(user_message))
+    else:
+        pipeline.add(
+            "emotion",
+            lambda: EmotionDetector.detect(user_message),
+            fallback=EmotionDetector.FALLBACK_EMOTION,
+        )
+    if include_bot:
+        if RulePolicy.skips(verdict, "bot"):
+            pipeline.add("bot", lambda: MioBot.rule_response(verdict[0]))
+        else:
+            pipeline.add(
+                "bot",
+                lambda: MioBot.generate_response(user_message, conversation_history),
+                fallback=MioBot.FALLBACK_RESPONSE,
+            )
+    if verdict:
+        async def rule_feedback(emotion: str) -> str:
+            return verdict[1]
+
+        pipeline.add("feedback", rule_feedback, depends_on=("emotion",))
+    else:
+        pipeline.add(
+            "feedback",
+            lambda emotion: VoiceFeedback.generate(user_message, emotion, conversation_history, check_rules=False),
+            depends_on=("emotion",),
+            fallback=VoiceFeedback.FALLBACK_FEEDBACK,
+        )
+    return pipeline
+
+async def _single_chunk(awaitable) -> AsyncIterator[str]:
+    """1つの結果を1チャンクのストリームとして返す"""
+    yield await awaitable
+
+async def _send_message_with_background_feedback(
+    request: ConversationRequest,
+    pipeline: StageGraph,
+    request_context: RequestContext,
+    verdict: Optional[Tuple[str, str]],
+) -> ConversationResponse:
+    """みおの応答だけを待って返し、感情検出・天の声はバックグラウンドで完了させる"""
+    tasks = pipeline.start()
+    try:
+        bot_response = await tasks["bot"]
+    except Exception as e:
+        logger.error("turn.failed", exc_info=True, session_id=request.session_id, error=type(e).__name__)
+        bot_response = "そうなんですね〜！もう少し詳しく教えてもらえますか？😊"
+        RequestContext.mark_degraded("bot", e)
+    emotion_task = tasks["emotion"]
+    # 感情が応答より先に判定済みならそのまま返す（未完了なら天の声と一緒に取得する）
+    detected_patterns = [emotion_task.result()] if emotion_task.done() and not emotion_task.exception() else []
+
+    # 天の声は空で記録し、生成が終わったら complete_feedback で埋める
+    # （各ステージは _resolve_history で固定した履歴を使うので、追加したこのターンは天の声のプロンプトに入らない）
+    turn_index = await _append_turn(request.session_id, request.user_message, bot_response, "")
+    feedback_id = str(uuid.uuid4())
+    await sessions.run(sessions.add_feedback, feedback_id, request.session_id)
+    feedback_jobs.submit(
+        feedback_id,
+        _finish_feedback(feedback_id, pipeline, tasks, request_context, request, verdict, bot_response, turn_index),
+    )
+
+    return ConversationResponse(
+        bot_response=bot_response,
+        voice_feedback="",
+        detected_patterns=detected_patterns,
+        stage_timings=dict(pipeline.timings),
+        degraded=list(request_context.degraded),
+        turn_index=turn_index,
+        feedback_id=feedback_id,
+    )
+
+@app.get("/api/conversation/feedback/{feedback_id}", response_model=FeedbackResponse)
+async def get_feedback(feedback_id: str, wait: float = 0):
+    """バックグラウンド生成した天の声を取得する。wait秒まで完了を待つ（ロングポーリング）
+
+    生成したワーカーならタスクの完了を待ち、他のワーカーで生成中ならセッション置き場を一定間隔で確認する。
+    """
+    deadline = time.monotonic() + min(max(wait, 0), FEEDBACK_LONG_POLL_MAX_SECONDS)
+    while True:
+        await feedback_jobs.wait(feedback_id, deadline - time.monotonic())
+        record = await sessions.run(sessions.get_feedback, feedback_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Feedback not found")
+        if record["result"] is not None:
+            return FeedbackResponse(feedback_id=feedback_id, status="ready", **record["result"])
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return FeedbackResponse(feedback_id=feedback_id, status="pending")
+        await asyncio.sleep(min(FeedbackJobs.POLL_INTERVAL, remaining))
+
+@app.post("/api/conversation/message/stream")
+async def send_message_stream(request: ConversationRequest):
+    """みおの応答をSSEでトークン単位に送り、天の声と感情は後続イベントで送る
+
+    イベント: token（応答の断片）→ bot_response（応答全文）→ voice_feedback
+    → detected_patterns → done（ステージ別所要時間・フォールバックしたステージ・完了ターン数）
+    """
+    conversation_history = await _resolve_history(request)
+
+    # 感情検出と天の声は応答のストリーミングと並行して進める
+    verdict = _check_rules_first(request.user_message)
+    pipeline = _build_turn_pipeline(request.user_message, conversation_history, verdict, include_bot=False)
+    if RulePolicy.skips(verdict, "bot"):
+        bot_stream = _single_chunk(MioBot.rule_response(verdict[0]))
+    else:
+        bot_stream = MioBot.stream_response(request.user_message, conversation_history)
+
+    async def event_stream():
+        start = time.perf_counter()
+        # 締め切りは応答本体のストリームではなく、後続の感情検出・天の声に適用する
+        request_context = RequestContext(REQUEST_DEADLINE_MS)
+        _request_context.set(request_context)
+        pipeline_task = asyncio.create_task(pipeline.run())
+        try:
+            chunks = []
+            async for chunk in bot_stream:
+                if not chunks:
+                    pipeline.timings["bot_first_token"] = round((time.perf_counter() - start) * 1000, 1)
+                chunks.append(chunk)
+                yield _sse_event("token", {"text": chunk})
+            bot_response = "".join(chunks).strip()
+            bot_elapsed = time.perf_counter() - start
+            pipeline.timings["bot"] = round(bot_elapsed * 1000, 1)
+            STAGE_LATENCY.observe(bot_elapsed, "bot")
+            yield _sse_event("bot_response", {"bot_response": bot_response})
+
+            try:
+                results = await pipeline_task
+                emotion = results["emotion"]
+                voice_feedback = results["feedback"]
+            except Exception as e:
+                logger.error("turn.stream_failed", exc_info=True, session_id=request.session_id, error=type(e).__name__)
+                emotion = EmotionDetector.FALLBACK_EMOTION
+                voice_feedback = VoiceFeedback.FALLBACK_FEEDBACK
+                for stage in ("emotion", "feedback"):
+                    RequestContext.mark_degraded(stage, e)
+
+            yield _sse_event("voice_feedback", {"voice_feedback": voice_feedback})
+            yield _sse_event("detected_patterns", {"detected_patterns": [emotion]})
+
+            turn_index = await _append_turn(request.session_id, request.user_message, bot_response, voice_feedback)
+            pipeline.timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+            yield _sse_event("done", {
+                "stage_timings": pipeline.timings,
+                "degraded": list(request_context.degraded),
+                "turn_index": turn_index,
+            })
+        finally:
+            if not pipeline_task.done():
+                pipeline_task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 @app.post("/api/conversation/end", response_model=MioImpressionResponse)
 async def end_conversation(request: ConversationEndRequest):
     """会話終了時のみおの感想を取得"""
-    print(f"=== 会話終了APIエンドポイント呼び出し ===")
-    print(f"リクエスト session_id: {request.session_id}")
-    
-    if request.session_id not in sessions:
-        print(f"エラー: セッションが見つかりません: {request.session_id}")
-        print(f"現在のセッション一覧: {list(sessions.keys())}")
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    # みおの感想を生成
-    print("みおの感想生成処理を開始...")
-    impression = await MioImpression.generate_final_impression(request.session_id)
-    
-    print(f"=== APIエンドポイントから返すレスポンス ===")
-    print(f"impression_text: '{impression.impression_text}'")
-    print(f"want_to_talk_again: {impression.want_to_talk_again}")
-    print(f"emotion_scores: {impression.emotion_scores}")
-    print(f"memorable_moments: {impression.memorable_moments}")
-    
-    # セッションをクリーンアップ（オプション）
-    # del sessions[request.session_id]
-    
-    return impression
+    with tracer.trace("POST /api/conversation/end", session_id=request.session_id):
+        # 感想の生成には締め切りを設けず、フォールバックしたかどうかだけを記録する
+        request_context = RequestContext(0)
+        _request_context.set(request_context)
+        with tracer.span("validate"):
+            if await sessions.run(sessions.get, request.session_id) is None:
+                active_sessions = await sessions.run(len, sessions)
+                logger.warning("sessions.not_found", session_id=request.session_id, active_sessions=active_sessions)
+                raise HTTPException(status_code=404, detail="Session not found")
+
+        # みおの感想を生成
+        started = time.perf_counter()
+        with tracer.span("stage.impression"):
+            impression = await MioImpression.generate_final_impression(request.session_id)
+        STAGE_LATENCY.observe(time.perf_counter() - started, "impression")
+
+        # セッションをクリーンアップ
+        with tracer.span("session.update", action="delete"):
+            await sessions.run(sessions.delete, request.session_id)
+
+        impression.degraded = list(request_context.degraded)
+        return impression
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,133 @@
+"""リクエスト単位のサンプリングプロファイラ
+
+X-Profile: 1 ヘッダーか ?profile=1 をつけ、X-Debug-Token に正しいトークンを送ったリクエストだけ、
+処理中のイベントループのスレッドのスタックを一定間隔で採取し、折りたたみ形式（flamegraph.pl / speedscope
+でそのまま読める「関数;関数;関数 回数」の行）で output_dir に保存する。保存先のファイル名は
+レスポンスの X-Profile-File ヘッダーで返す。
+
+ASGIミドルウェアなのでリクエストボディの検証（pydantic）やストリーミングの送信まで含めて採取できる。
+採取するのはスレッド全体なので、同時に処理している他のリクエストのスタックも混ざる。
+同時に採取するのは1リクエストだけで、採取中に来た別のプロファイル要求は通常どおり処理する。
+採取スレッドはGILを取れた時点でしか動けないため、CPUを使い続ける区間の分解能は
+sys.getswitchinterval()（既定5ms）程度になる。
+"""
+import asyncio
+import collections
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from typing import Optional
+from urllib.parse import parse_qs
+
+
+class SamplingProfiler:
+    """別スレッドから対象スレッドのスタックを interval_ms ごとに採取する"""
+
+    def __init__(self, thread_id: int, interval_ms: float = 5.0, max_seconds: float = 30.0):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.max_seconds = max_seconds
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[self._stack(frame)] += 1
+
+    @staticmethod
+    def _stack(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(name.replace(";", ":") for name in reversed(names))
+
+    def folded(self) -> str:
+        """折りたたみ形式（多い順）"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class ProfilingMiddleware:
+    """プロファイル指定つきの認可済みリクエストだけを SamplingProfiler で採取する"""
+
+    def __init__(self, app, token: str, output_dir: str = "profiles", interval_ms: float = 5.0,
+                 max_seconds: float = 30.0):
+        self.app = app
+        self.token = token
+        self.output_dir = output_dir
+        self.interval_ms = interval_ms
+        self.max_seconds = max_seconds
+        self._active = False
+        self.stats = {"profiled": 0, "busy": 0, "unauthorized": 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+        if not self._authorized(scope):
+            self.stats["unauthorized"] += 1
+            await self.app(scope, receive, send)
+            return
+        if self._active:
+            self.stats["busy"] += 1
+            await self.app(scope, receive, send)
+            return
+
+        filename = self._filename(scope)
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-file", filename.encode())]}
+            await send(message)
+
+        self._active = True
+        profiler = SamplingProfiler(threading.get_ident(), self.interval_ms, self.max_seconds)
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            profiler.stop()
+            self._active = False
+            self.stats["profiled"] += 1
+            await asyncio.get_running_loop().run_in_executor(None, self._save, filename, profiler.folded())
+
+    @staticmethod
+    def _requested(scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == b"x-profile":
+                return value not in (b"", b"0", b"false")
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        return query.get("profile", ["0"])[-1] not in ("", "0", "false")
+
+    def _authorized(self, scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == b"x-debug-token":
+                return hmac.compare_digest(value, self.token.encode())
+        return False
+
+    @staticmethod
+    def _filename(scope) -> str:
+        path = scope.get("path", "/").strip("/").replace("/", "_") or "root"
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{scope.get('method', 'GET')}-{path}-{uuid.uuid4().hex[:8]}.folded"
+
+    def _save(self, filename: str, folded: str):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, filename), "w", encoding="utf-8") as f:
+            f.write(folded)
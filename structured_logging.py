@@ -0,0 +1,153 @@
+"""構造化ログ（JSON Lines）
+
+リクエスト処理中は LogRecord をキューに積むだけにし、整形・マスキング・書き出しは
+QueueListener のスレッドで行う。INFO以下のイベントはサンプリングで間引ける（WARNING以上は常に残す）。
+
+使い方:
+    logger = EventLogger("cabatore")
+    logger.info("turn.completed", session_id=session_id, user_message=message)
+
+ユーザー発言・生成テキストなど SENSITIVE_FIELDS のフィールドは、LOG_REDACTION に応じて
+ハッシュ（既定）・先頭数文字・そのまま のいずれかで出力する。APIキーらしき文字列は常に伏せる。
+"""
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# 内容を伏せて出力するフィールド
+SENSITIVE_FIELDS = frozenset({
+    "user_message", "bot_response", "voice_feedback", "impression_text", "prompt", "conversation", "generated",
+})
+API_KEY_PATTERN = re.compile(r"AIza[0-9A-Za-z_\-]{20,}")
+TRUNCATE_CHARS = 20
+
+_sampling = {"rate": 1.0, "rates": {}}
+
+
+def redact(value, mode: str):
+    """機微なフィールドの値を伏せる（hash: 長さとハッシュ / truncate: 先頭数文字 / none: そのまま）"""
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if mode == "none":
+        return API_KEY_PATTERN.sub("[REDACTED]", text)
+    if mode == "truncate":
+        head = API_KEY_PATTERN.sub("[REDACTED]", text[:TRUNCATE_CHARS])
+        return head + ("…" if len(text) > TRUNCATE_CHARS else "")
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    return {"len": len(text), "sha256": digest}
+
+
+class JSONFormatter(logging.Formatter):
+    """LogRecord を1行のJSONにする（リスナースレッドで実行される）"""
+
+    def __init__(self, redaction: str = "hash"):
+        super().__init__()
+        self.redaction = redaction
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": API_KEY_PATTERN.sub("[REDACTED]", record.getMessage()),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            if key in SENSITIVE_FIELDS and value is not None:
+                entry[key] = redact(value, self.redaction)
+            elif isinstance(value, str):
+                entry[key] = API_KEY_PATTERN.sub("[REDACTED]", value)
+            else:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = API_KEY_PATTERN.sub("[REDACTED]", self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(JSONFormatter):
+    """開発用の読みやすい1行形式（マスキングはJSONと同じ）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = json.loads(super().format(record))
+        head = f"{entry.pop('ts')} {entry.pop('level'):7} {entry.pop('event')}"
+        entry.pop("logger")
+        exc = entry.pop("exc", None)
+        fields = " ".join(f"{key}={json.dumps(value, ensure_ascii=False)}" for key, value in entry.items())
+        return f"{head} {fields}" + (f"\n{exc}" if exc else "")
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯なら待たずに捨てる。整形はリスナー側に任せる"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 既定の prepare は呼び出し元スレッドで整形してしまうため、そのまま渡す
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+class EventLogger:
+    """イベント名＋キーワード引数のフィールドで記録するロガー"""
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(name)
+
+    def debug(self, event: str, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, exc_info: bool = False, **fields):
+        self._log(logging.ERROR, event, fields, exc_info)
+
+    def _log(self, level: int, event: str, fields: Dict, exc_info: bool = False):
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING:
+            rate = _sampling["rates"].get(event, _sampling["rate"])
+            if rate < 1.0 and random.random() >= rate:
+                return
+        self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+def setup_logging(
+    name: str,
+    level: str = "INFO",
+    log_format: str = "json",
+    sample_rate: float = 1.0,
+    sample_rates: Optional[Dict[str, float]] = None,
+    redaction: str = "hash",
+    queue_size: int = 10000,
+) -> logging.handlers.QueueListener:
+    """name のロガーにキュー経由の出力を設定し、書き出しスレッドを起動する"""
+    _sampling["rate"] = sample_rate
+    _sampling["rates"] = dict(sample_rates or {})
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(TextFormatter(redaction) if log_format == "text" else JSONFormatter(redaction))
+    log_queue = queue.Queue(maxsize=queue_size)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger(name)
+    logger.handlers = [NonBlockingQueueHandler(log_queue)]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return listener
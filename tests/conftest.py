@@ -0,0 +1,9 @@
+"""テスト共通設定：main の読み込み前に、ネットワーク不要の偽LLMバックエンドを指定する"""
+import os
+import sys
+
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("FAKE_LLM_LATENCY_MS", "1")
+os.environ.setdefault("SESSION_BACKEND", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,87 @@
+"""バックグラウンド天の声モード：評価中のターンがプロンプトに混ざらないこと、結果がセッション置き場に残ること"""
+from fastapi.testclient import TestClient
+
+import main
+from llm_backends import FakeLLMBackend
+
+
+class PromptRecorder(FakeLLMBackend):
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    async def generate(self, stage, prompt, generation_config=None):
+        self.prompts.append((stage, prompt))
+        return await super().generate(stage, prompt, generation_config)
+
+
+def _feedback_history(prompt: str) -> str:
+    return prompt.split("=== 最近の会話の流れ ===", 1)[1].split("=== 今回評価する発言 ===", 1)[0]
+
+
+def test_background_feedback_prompt_excludes_current_turn(monkeypatch):
+    recorder = PromptRecorder()
+    monkeypatch.setattr(main.LLMClient, "backend", recorder)
+    with TestClient(main.app) as client:
+        session_id = client.post("/api/session/create").json()["session_id"]
+        messages = ["最近カフェ巡りにハマってるんですよ", "週末に映画を見に行ったんですけど、すごく感動しました"]
+        for message in messages:
+            response = client.post("/api/conversation/message", json={
+                "session_id": session_id,
+                "user_message": message,
+                "background_feedback": True,
+            })
+            assert response.status_code == 200
+            feedback = client.get(f"/api/conversation/feedback/{response.json()['feedback_id']}", params={"wait": 5})
+            assert feedback.json()["status"] == "ready"
+
+    feedback_prompts = [prompt for stage, prompt in recorder.prompts if stage == "feedback"]
+    assert len(feedback_prompts) == 2
+    first, second = (_feedback_history(prompt) for prompt in feedback_prompts)
+    # 1ターン目は履歴なし、2ターン目は1ターン目だけが履歴に入る
+    assert messages[0] not in first
+    assert messages[0] in second
+    assert messages[1] not in second
+
+
+def _post_background_turn(client, session_id: str, message: str) -> str:
+    response = client.post("/api/conversation/message", json={
+        "session_id": session_id,
+        "user_message": message,
+        "background_feedback": True,
+    })
+    assert response.status_code == 200
+    assert response.json()["voice_feedback"] == ""
+    return response.json()["feedback_id"]
+
+
+def test_background_feedback_is_backfilled_into_history():
+    with TestClient(main.app) as client:
+        session_id = client.post("/api/session/create").json()["session_id"]
+        feedback_id = _post_background_turn(client, session_id, "最近カフェ巡りにハマってるんですよ")
+        feedback = client.get(f"/api/conversation/feedback/{feedback_id}", params={"wait": 5}).json()
+        assert feedback["status"] == "ready"
+        history = main.sessions.get(session_id)["history"]
+        assert [msg.role for msg in history] == ["user", "bot", "voice"]
+        assert history[2].content == feedback["voice_feedback"] != ""
+
+
+def test_background_feedback_is_readable_from_another_worker(tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.db")
+    monkeypatch.setattr(main, "sessions", main.SQLiteSessionStore(path, ttl_seconds=1800, max_sessions=10))
+    with TestClient(main.app) as client:
+        session_id = client.post("/api/session/create").json()["session_id"]
+        feedback_id = _post_background_turn(client, session_id, "最近カフェ巡りにハマってるんですよ")
+        ready = client.get(f"/api/conversation/feedback/{feedback_id}", params={"wait": 5}).json()
+        assert ready["status"] == "ready"
+
+        # 別のワーカー：同じDBを開いた別のストアと、生成中のタスクを持たないジョブ一覧
+        other_store = main.SQLiteSessionStore(path, ttl_seconds=1800, max_sessions=10)
+        monkeypatch.setattr(main, "sessions", other_store)
+        monkeypatch.setattr(main, "feedback_jobs", main.FeedbackJobs())
+        assert client.get(f"/api/conversation/feedback/{feedback_id}").json() == ready
+        assert other_store.get(session_id)["history"][2].content == ready["voice_feedback"]
+
+        other_store.add_feedback("still-running", session_id)
+        assert client.get("/api/conversation/feedback/still-running").json()["status"] == "pending"
+        assert client.get("/api/conversation/feedback/unknown").status_code == 404
@@ -0,0 +1,24 @@
+"""benchmark.percentile の最近傍順位法"""
+from benchmark import percentile
+
+
+def test_nearest_rank_on_1_to_100():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+
+
+def test_nearest_rank_on_20_samples():
+    values = [float(v) for v in range(1, 21)]
+    assert percentile(values, 50) == 10
+    assert percentile(values, 95) == 19
+    assert percentile(values, 99) == 20
+
+
+def test_small_and_empty_inputs():
+    assert percentile([], 95) == 0.0
+    assert percentile([7.0], 50) == 7.0
+    assert percentile([3.0, 1.0, 2.0], 0) == 1.0
+    assert percentile([3.0, 1.0, 2.0], 50) == 2.0
@@ -0,0 +1,22 @@
+"""EmotionBatcher：まとめた判定のタスクを判定が終わるまで保持すること"""
+import asyncio
+
+import main
+
+
+def test_batch_tasks_are_held_until_done():
+    batcher = main.EmotionBatcher(batch_size=2, wait_ms=1000)
+
+    async def scenario():
+        first = asyncio.create_task(batcher.classify("今日は楽しかった"))
+        second = asyncio.create_task(batcher.classify("仕事で疲れた"))
+        await asyncio.sleep(0)
+        running = len(batcher._running)
+        results = await asyncio.gather(first, second)
+        return running, results
+
+    running, results = asyncio.run(scenario())
+    assert running == 1
+    assert all(emotion in main.VALID_EMOTIONS for emotion in results)
+    assert batcher._running == set()
+    assert batcher.stats["batches"] == 1
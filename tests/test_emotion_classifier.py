@@ -0,0 +1,30 @@
+"""ローカル感情分類器の確信度が、学習データと関係の薄い長文で閾値を超えないこと"""
+import pytest
+
+from emotion_classifier import EmotionClassifier
+
+DEFAULT_THRESHOLD = 0.8  # main.LOCAL_EMOTION_THRESHOLD の既定値
+
+DIARY = "今日は朝から電車に乗って会社に行きました。昼ごはんは同僚とラーメンを食べました。夜は家で本を読んでから寝ました。"
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return EmotionClassifier.train([])
+
+
+@pytest.mark.parametrize("repeat", [1, 2, 5, 20])
+def test_long_out_of_domain_text_stays_below_threshold(classifier, repeat):
+    _, confidence = classifier.classify(DIARY * repeat)
+    assert confidence < DEFAULT_THRESHOLD
+
+
+def test_confidence_does_not_grow_with_repetition(classifier):
+    _, once = classifier.classify(DIARY)
+    _, many = classifier.classify(DIARY * 20)
+    assert many < DEFAULT_THRESHOLD
+    assert many - once < 0.05
+
+
+def test_seed_phrase_is_still_confident(classifier):
+    assert classifier.classify("締め切りが間に合わない") == ("焦り", pytest.approx(0.98, abs=0.02))
@@ -0,0 +1,113 @@
+"""LLMScheduler：優先度順の送出、打ち切り・キャンセル時の送出枠の数え方、トークン補充での再送出"""
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+def _scheduler(max_in_flight=1, rate_per_minute=0, burst=1, shed_wait_ms=None):
+    return main.LLMScheduler(rate_per_minute, burst, max_in_flight, shed_wait_ms or {})
+
+
+def test_reply_is_dispatched_before_waiting_feedback():
+    scheduler = _scheduler()
+
+    async def scenario():
+        await scheduler.acquire("emotion")  # 枠を埋めておく
+        order = []
+
+        async def call(stage):
+            await scheduler.acquire(stage)
+            order.append(stage)
+
+        feedback = asyncio.create_task(call("feedback"))
+        await asyncio.sleep(0)
+        reply = asyncio.create_task(call("bot"))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth() == 2
+
+        scheduler.release()
+        await asyncio.wait_for(reply, timeout=1)
+        assert not feedback.done()
+
+        scheduler.release()
+        await asyncio.wait_for(feedback, timeout=1)
+        scheduler.release()
+        return order
+
+    assert asyncio.run(scenario()) == ["bot", "feedback"]
+    assert scheduler.in_flight == 0
+
+
+def test_shed_waiter_does_not_leak_in_flight():
+    scheduler = _scheduler(shed_wait_ms={main.PRIORITY_FEEDBACK: 20})
+
+    async def scenario():
+        await scheduler.acquire("bot")
+        with pytest.raises(main.LLMOverloadedError):
+            await scheduler.acquire("feedback")
+        assert scheduler.in_flight == 1
+        scheduler.release()
+        # 打ち切った呼び出しに枠は割り当てられず、次の呼び出しがそのまま通る
+        await scheduler.acquire("feedback")
+        scheduler.release()
+
+    asyncio.run(scenario())
+    assert scheduler.in_flight == 0
+    assert scheduler.queue_depth() == 0
+    assert scheduler.stats["shed"] == 1
+
+
+@pytest.mark.parametrize("stage", ["bot", "feedback"])
+def test_cancel_after_slot_granted_restores_in_flight(stage):
+    scheduler = _scheduler(shed_wait_ms={main.PRIORITY_FEEDBACK: 5000})
+
+    async def scenario():
+        await scheduler.acquire("bot")
+        waiter = asyncio.create_task(scheduler.acquire(stage))
+        await asyncio.sleep(0)
+        # 枠を渡した直後、待っていた側が再開する前にキャンセルする
+        scheduler.release()
+        assert scheduler.in_flight == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
+    assert scheduler.in_flight == 0
+    assert scheduler.queue_depth() == 0
+
+
+def test_cancel_while_queued_leaves_count_unchanged():
+    scheduler = _scheduler()
+
+    async def scenario():
+        await scheduler.acquire("bot")
+        waiter = asyncio.create_task(scheduler.acquire("emotion"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.in_flight == 1
+        scheduler.release()
+
+    asyncio.run(scenario())
+    assert scheduler.in_flight == 0
+
+
+def test_token_bucket_wakes_up_waiting_call():
+    scheduler = _scheduler(max_in_flight=10, rate_per_minute=600, burst=1)  # 0.1秒に1回
+
+    async def scenario():
+        await scheduler.acquire("bot")
+        started = time.monotonic()
+        # release() がなくても、トークンが補充されたら送出される
+        await asyncio.wait_for(scheduler.acquire("bot"), timeout=2)
+        return time.monotonic() - started
+
+    waited = asyncio.run(scenario())
+    assert 0.05 <= waited < 1
+    assert scheduler.in_flight == 2
+    assert scheduler.stats["granted"] == 2
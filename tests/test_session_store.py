@@ -0,0 +1,70 @@
+"""SQLiteSessionStore の最終アクセス更新の間引きと、DB操作をイベントループ外で行うこと"""
+import asyncio
+import threading
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def _last_access(store, session_id):
+    return store._conn.execute("SELECT last_access FROM sessions WHERE id = ?", (session_id,)).fetchone()[0]
+
+
+def test_get_skips_touch_within_interval(tmp_path, monkeypatch):
+    store = main.SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl_seconds=1800, max_sessions=10,
+                                    touch_interval=60)
+    now = 1_000_000.0
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    store.create("s1")
+
+    now += 30
+    assert store.get("s1") is not None
+    assert _last_access(store, "s1") == 1_000_000.0
+
+    now += 31
+    assert store.get("s1") is not None
+    assert _last_access(store, "s1") == now
+
+
+def test_untouched_session_still_expires(tmp_path, monkeypatch):
+    store = main.SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl_seconds=100, max_sessions=10,
+                                    touch_interval=60)
+    now = 1_000_000.0
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    store.create("s1")
+
+    now += 50
+    assert store.get("s1") is not None
+    now += 51
+    assert store.get("s1") is None
+
+
+def test_run_executes_db_work_off_the_event_loop(tmp_path):
+    store = main.SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl_seconds=1800, max_sessions=10)
+
+    async def scenario():
+        loop_thread = threading.get_ident()
+        db_thread = await store.run(threading.get_ident)
+        session = await store.run(store.create, "s1")
+        return loop_thread, db_thread, session
+
+    loop_thread, db_thread, session = asyncio.run(scenario())
+    assert db_thread != loop_thread
+    assert session["turns"] == 0
+
+
+def test_conversation_on_sqlite_backend(tmp_path, monkeypatch):
+    store = main.SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl_seconds=1800, max_sessions=10)
+    monkeypatch.setattr(main, "sessions", store)
+    with TestClient(main.app) as client:
+        session_id = client.post("/api/session/create").json()["session_id"]
+        response = client.post("/api/conversation/message", json={
+            "session_id": session_id,
+            "user_message": "最近カフェ巡りにハマってるんですよ",
+        })
+        assert response.status_code == 200
+        assert response.json()["turn_index"] == 1
+        assert "cabatore_active_sessions 1" in client.get("/metrics").text
+        assert client.post("/api/conversation/end", json={"session_id": session_id}).status_code == 200
+    assert len(store) == 0
@@ -0,0 +1,99 @@
+"""辞書の一括照合（Aho-Corasick）が、語ごとの部分一致・末尾一致と同じ判定になること"""
+import json
+import random
+from datetime import datetime
+
+import pytest
+
+import main
+from text_matcher import LexiconMatcher
+
+with open(main.LEXICON_PATH, encoding="utf-8") as f:
+    LEXICONS = json.load(f)
+
+
+def baseline_rule(message: str):
+    """一括照合を入れる前の、語ごとの in / endswith による判定"""
+    if any(word in message for word in LEXICONS["inappropriate"]):
+        return "inappropriate"
+    stripped = message.strip()
+    if stripped in LEXICONS["short_responses"] or len(stripped) <= 3:
+        return "short"
+    if any(word in message for word in LEXICONS["rude"]):
+        return "rude"
+    if any(message.endswith(ending) for ending in LEXICONS["command_endings"]):
+        return "command"
+    return None
+
+
+def baseline_scores(contents):
+    positive_words = 0
+    moments = []
+    for content in contents:
+        positive_words += sum(1 for word in LEXICONS["positive"] if word in content)
+        if len(moments) < 3:
+            if len(content) > 50:
+                moments.append("たくさん話してくれた時")
+            if "!" in content or "！" in content:
+                moments.append("熱く語ってくれた時")
+            if any(word in content for word in LEXICONS["kind"]):
+                moments.append("優しい言葉をかけてくれた時")
+    return positive_words, moments[:3]
+
+
+def rule_of(message: str):
+    verdict = main.ConversationAnalyzer.evaluate(message)
+    return verdict[0] if verdict else None
+
+
+def session_scores(contents):
+    scores = main.SessionScores()
+    scores.add([main.Message(role="user", content=content, timestamp=datetime(2024, 1, 1)) for content in contents])
+    return scores.positive_words, scores.moments
+
+
+@pytest.mark.parametrize("message", [
+    "今日は楽しい一日でした、ありがとう",   # positive と kind の両方に入る語
+    "楽しい楽しい嬉しい",                    # 同じ語の繰り返しは1語として数える
+    "ありがとうございます、嬉しいです",
+    "もう黙ってやめろ",                      # 末尾の命令形
+    "やめろって言われたけど気にしてないよ",  # 途中のやめろは命令口調ではない
+    "ちゃんと宿題しろ",
+    "白いシャツを着ていったらしろ",
+    "しろいねこを見かけたんだよね",
+    "それは面白くないって言われちゃいました",
+    "やめときなって友達に言われちゃいました",
+    "そんなこと言うのはやめときな",
+    "うんうん、それでね、昨日の話なんだけど",  # うん（短い返事）とうんこ・うんち（不適切）が同じ接頭辞
+    "はーい、わかりましたよ、今日もよろしくね",
+    "はい",
+    "エロ",
+    "ダメダメ、それは違うと思いますよ",
+    "",
+])
+def test_rules_match_baseline_on_tricky_messages(message):
+    assert rule_of(message) == baseline_rule(message)
+    assert session_scores([message]) == baseline_scores([message])
+
+
+def test_rules_and_scores_match_baseline_on_random_messages():
+    rng = random.Random(20240101)
+    words = sorted({word for lexicon in LEXICONS.values() for word in lexicon})
+    fillers = ["今日は", "ね", "、", "！", "です", "しろい", "うん", "や", "め", "楽し", "いい", "あり", "がとう", " "]
+    for _ in range(3000):
+        parts = [rng.choice(words if rng.random() < 0.4 else fillers) for _ in range(rng.randint(0, 12))]
+        message = "".join(parts)
+        assert rule_of(message) == baseline_rule(message), message
+    for _ in range(300):
+        contents = ["".join(rng.choice(words + fillers) for _ in range(rng.randint(0, 30))) for _ in range(5)]
+        assert session_scores(contents) == baseline_scores(contents), contents
+
+
+def test_scan_reports_overlapping_and_suffix_matches():
+    matcher = LexiconMatcher({"a": ["abcd", "bc"], "b": ["bcd", "c"], "end": ["cd"]})
+    hits = matcher.scan("xabcd")
+    assert hits.words == {"a": {"abcd", "bc"}, "b": {"bcd", "c"}, "end": {"cd"}}
+    assert hits.suffixes == {"a": {"abcd"}, "b": {"bcd"}, "end": {"cd"}}
+    # 失敗遷移：abce で abcd の途中から bc・c の一致に移る
+    assert matcher.scan("abce").words == {"a": {"bc"}, "b": {"c"}}
+    assert matcher.scan("abce").suffixes == {}
@@ -0,0 +1,103 @@
+"""複数辞書の一括照合（Aho-Corasick法）
+
+辞書の語数に関係なく、メッセージを1回走査するだけで全カテゴリの一致を列挙する。
+"""
+import json
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+class AhoCorasick:
+    """パターン→カテゴリ集合を登録し、テキスト中の全出現を1パスで見つける"""
+
+    def __init__(self, patterns: Dict[str, Set[str]]):
+        # 状態0が根。_goto[状態][文字] = 次の状態
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, Tuple[str, ...]]]] = [[]]
+
+        for pattern, categories in patterns.items():
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append((pattern, tuple(sorted(categories))))
+
+        # 幅優先で失敗遷移を作り、接尾辞側の出力を引き継ぐ
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                candidate = self._goto[fail].get(char, 0)
+                self._fail[next_state] = candidate if candidate != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def iter_matches(self, text: str) -> Iterable[Tuple[int, str, Tuple[str, ...]]]:
+        """(終了位置, パターン, カテゴリ) を出現順に返す。終了位置は一致の直後の添字"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern, categories in output[state]:
+                yield index + 1, pattern, categories
+
+
+class LexiconMatcher:
+    """カテゴリ別の辞書をまとめた照合器"""
+
+    def __init__(self, lexicons: Dict[str, List[str]]):
+        self.lexicons = lexicons
+        patterns: Dict[str, Set[str]] = {}
+        for category, words in lexicons.items():
+            for word in words:
+                patterns.setdefault(word, set()).add(category)
+        self._automaton = AhoCorasick(patterns)
+
+    @classmethod
+    def load(cls, path: str) -> "LexiconMatcher":
+        """{カテゴリ: [語, ...]} 形式のJSONファイルから作る"""
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def scan(self, text: str) -> "LexiconHits":
+        """テキストを1回走査してカテゴリ別の一致をまとめる"""
+        hits = LexiconHits()
+        text_length = len(text)
+        for end, pattern, categories in self._automaton.iter_matches(text):
+            for category in categories:
+                hits.words.setdefault(category, set()).add(pattern)
+                if end == text_length:
+                    hits.suffixes.setdefault(category, set()).add(pattern)
+        return hits
+
+
+class LexiconHits:
+    """scan の結果。words はどこかに含まれた語、suffixes は末尾に一致した語"""
+
+    __slots__ = ("words", "suffixes")
+
+    def __init__(self):
+        self.words: Dict[str, Set[str]] = {}
+        self.suffixes: Dict[str, Set[str]] = {}
+
+    def contains(self, category: str) -> bool:
+        return category in self.words
+
+    def ends_with(self, category: str) -> bool:
+        return category in self.suffixes
+
+    def count(self, category: str) -> int:
+        """含まれていた異なり語数"""
+        return len(self.words.get(category, ()))
@@ -0,0 +1,272 @@
+"""プロセス内のリクエストトレース
+
+1リクエストを1トレースとし、検証・ルールチェック・各ステージ・LLM呼び出し・セッション更新をスパンで記録する。
+終わったトレースは件数上限つきのリングバッファに残し、/debug/traces から参照する。
+export_path を指定すると、OTLP/JSON（resourceSpans 形式）で1トレース1行ずつファイルに追記する。
+
+使い方:
+    with tracer.trace("conversation.message", session_id=session_id):
+        with tracer.span("validate"):
+            ...
+
+現在のスパンは contextvar で引き継ぐため、トレース中に起動したタスクのスパンは同じトレースに入る。
+トレースの外で作ったスパンは何も記録しない。バックグラウンドで続くステージのスパンは、
+トレース終了後もバッファ上のトレースに追加される（ファイル出力には含まれない）。
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+# OTLPのスパン種別・ステータス
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """トレース内の1区間"""
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict,
+                 kind: int = SPAN_KIND_INTERNAL):
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        """例外を記録する（再試行で続行する場合も含む）"""
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.trace.spans.append(self)
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        if self.end_ns is None:
+            return None
+        return round((self.end_ns - self.start_ns) / 1e6, 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "offset_ms": round((self.start_ns - self.trace.root.start_ns) / 1e6, 1),
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": STATUS_CODE_ERROR, "message": self.error} if self.error else {"code": STATUS_CODE_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """トレース外・トレース無効時のスパン（何も記録しない）"""
+
+    def set(self, key: str, value):
+        pass
+
+    def record_error(self, error: BaseException):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Trace:
+    """1リクエスト分のスパンの集まり"""
+
+    def __init__(self, name: str, attributes: Dict):
+        self.trace_id = _new_id(128)
+        self.spans: List[Span] = []
+        self.root = Span(self, name, None, attributes, kind=SPAN_KIND_SERVER)
+
+    def summary(self) -> dict:
+        slowest = max((span for span in self.spans if span is not self.root),
+                      key=lambda span: span.duration_ms or 0, default=None)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "start": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.root.start_ns / 1e9)),
+            "duration_ms": self.root.duration_ms,
+            "attributes": self.root.attributes,
+            "error": self.root.error,
+            "span_count": len(self.spans),
+            "slowest_span": {"name": slowest.name, "duration_ms": slowest.duration_ms} if slowest else None,
+        }
+
+    def to_dict(self) -> dict:
+        spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return {**self.summary(), "spans": [span.to_dict() for span in spans]}
+
+    def to_otlp(self, service_name: str) -> dict:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": service_name},
+                    "spans": [span.to_otlp() for span in self.spans],
+                }],
+            }]
+        }
+
+
+class _SpanScope:
+    """with で囲んだ区間をスパンとして記録する。activate=True なら中のスパンの親になる"""
+
+    def __init__(self, tracer: "Tracer", span: Optional[Span], activate: bool = True, root: bool = False):
+        self.tracer = tracer
+        self.span = span
+        self.activate = activate
+        self.root = root
+        self._token = None
+
+    def __enter__(self):
+        if self.span is None:
+            return NOOP_SPAN
+        if self.activate:
+            self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        if exc is not None and not isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+            self.span.record_error(exc)
+        elif isinstance(exc, asyncio.CancelledError):
+            self.span.set("cancelled", True)
+        self.span.end()
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # 別のコンテキストで閉じられた場合（ジェネレータの後始末など）
+                pass
+        if self.root:
+            self.tracer._finish(self.span.trace)
+        return False
+
+
+class Tracer:
+    """トレースの作成とリングバッファへの保存、OTLP/JSONの書き出し"""
+
+    def __init__(self, service_name: str, buffer_size: int = 200, export_path: str = "", enabled: bool = True):
+        self.service_name = service_name
+        self.enabled = enabled
+        self.export_path = export_path
+        self._traces = deque(maxlen=max(buffer_size, 1))
+        self._export_lock = threading.Lock()
+        self.stats = {"recorded": 0, "exported": 0, "export_errors": 0}
+
+    def trace(self, name: str, **attributes) -> _SpanScope:
+        """リクエスト全体のトレースを開始する（ルートスパン）"""
+        if not self.enabled:
+            return _SpanScope(self, None)
+        return _SpanScope(self, Trace(name, attributes).root, root=True)
+
+    def span(self, name: str, activate: bool = True, **attributes) -> _SpanScope:
+        """現在のトレースに子スパンを追加する。トレース外なら何も記録しない
+
+        ストリームを返す非同期ジェネレータの中など、yield をまたぐ区間は activate=False にする。
+        """
+        parent = _current_span.get()
+        if parent is None:
+            return _SpanScope(self, None)
+        return _SpanScope(self, Span(parent.trace, name, parent.span_id, attributes), activate=activate)
+
+    @staticmethod
+    def current_span():
+        """現在のスパン（トレース外なら何もしないスパン）"""
+        return _current_span.get() or NOOP_SPAN
+
+    @staticmethod
+    def detach():
+        """このタスクの以降の処理を現在のトレースから切り離す（複数リクエストで共有する処理用）"""
+        _current_span.set(None)
+
+    def _finish(self, trace: Trace):
+        self._traces.append(trace)
+        self.stats["recorded"] += 1
+        if not self.export_path:
+            return
+        line = json.dumps(trace.to_otlp(self.service_name), ensure_ascii=False)
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._export, line)
+        except RuntimeError:
+            self._export(line)
+
+    def _export(self, line: str):
+        try:
+            with self._export_lock, open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.stats["exported"] += 1
+        except OSError:
+            self.stats["export_errors"] += 1
+
+    def recent(self, limit: int = 50, session_id: Optional[str] = None, min_duration_ms: float = 0) -> List[dict]:
+        """新しい順のトレース概要"""
+        summaries = []
+        for trace in reversed(self._traces):
+            if session_id and trace.root.attributes.get("session_id") != session_id:
+                continue
+            if (trace.root.duration_ms or 0) < min_duration_ms:
+                continue
+            summaries.append(trace.summary())
+            if len(summaries) >= limit:
+                break
+        return summaries
+
+    def get(self, trace_id: str) -> Optional[dict]:
+        for trace in self._traces:
+            if trace.trace_id == trace_id:
+                return trace.to_dict()
+        return None